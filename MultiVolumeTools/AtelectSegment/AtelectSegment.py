@@ -4,7 +4,50 @@ import vtk, qt, ctk, slicer
 from slicer.ScriptedLoadableModule import *
 from slicer.util import MRMLNodeNotFoundException
 import logging
+import json
+import zlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import numpy as np
+from MVTConvert import MVTConvertLogic, SESSION_TOKEN
+
+# Slices classified by each task when segmenting on a thread pool
+DEFAULT_SLICES_PER_CHUNK = 16
+
+# Gattinoni density bands.  A voxel between HU_EDGES[i - 1] (exclusive) and
+# HU_EDGES[i] (inclusive) is of class HU_CLASSES[i]: 1 atelectasis, 2 poorly
+# aerated, 3 normally aerated and 4 overdistended, 0 outside every band.
+HU_EDGES = (-1000, -900, -500, -100, 100)
+HU_CLASSES = (0, 4, 3, 2, 1, 0)
+
+# The same bands for floating point input, assumed bounded 0 to 1.0.  Here the
+# lower edges are inclusive and the upper exclusive, with 1.0 itself in class 4.
+# The edges are compared at the precision of the input.
+FRACTION_EDGES = (0.0, 0.1, 0.5, 0.9, float(np.nextafter(np.float32(1.0), np.float32(2.0))))
+FRACTION_CLASSES = (0, 1, 2, 3, 4, 0)
+
+# Band presets available without a presets file, as (edges, classes, right)
+# with the meanings above.  right is True when the upper edge of each band is
+# inclusive.
+BUILTIN_PRESETS = {
+  'Gattinoni HU': (HU_EDGES, HU_CLASSES, True),
+  'Gattinoni fraction': (FRACTION_EDGES, FRACTION_CLASSES, False),
+  }
+
+# Band presets read by default, if present
+DEFAULT_PRESETS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'AtelectSegmentBands.json')
+
+# Lookup tables and digitize arrays already compiled this session, by dtype
+# and band definition
+_compiledBands = {}
+
+# Output volume attribute holding the slab digests of the last incremental run
+DIGESTS_ATTRIBUTE = 'AtelectSegment.SlabDigests'
+
+# Names of the classes, as shown in the LungColours table
+CLASS_NAMES = ('Background', 'Atelectasis', 'Poorly Aerated', 'Normally Aerated', 'Overdistended')
+
+# Columns of the per-frame statistics table and CSV
+STATISTICS_COLUMNS = ('frame', 'class', 'name', 'count', 'volume_ml', 'fraction')
 
 #
 # AtelectSegment
@@ -19,7 +62,7 @@ class AtelectSegment(ScriptedLoadableModule):
     ScriptedLoadableModule.__init__(self, parent)
     self.parent.title = "AtelectSegment" # TODO make this more human readable by adding spaces
     self.parent.categories = ["MultiVolumeTools"]
-    self.parent.dependencies = []
+    self.parent.dependencies = ["MVTConvert"]
     self.parent.contributors = ["John Cronin (KCL)"] # replace with "Firstname Lastname (Organization)"
     self.parent.helpText = """
     Automatically segment an image based on density as per Gattinoni thresholds.  Optionally mask the output with a label map.
@@ -96,6 +139,39 @@ class AtelectSegmentWidget(ScriptedLoadableModuleWidget):
     self.ovol.setToolTip( "Pick the output to the algorithm." )
     parametersFormLayout.addRow("Output Label Map: ", self.ovol)
 
+    self.chunk = qt.QLineEdit()
+    self.chunk.text = '%d' % DEFAULT_SLICES_PER_CHUNK
+    self.chunk.setToolTip( "Number of slices classified at once by each thread." )
+    parametersFormLayout.addRow("Slices per chunk: ", self.chunk)
+
+    # band presets
+    self.preset = qt.QComboBox()
+    self.preset.setToolTip( "Density bands to classify with.  Automatic picks the Gattinoni HU or fraction bands from the input type." )
+    parametersFormLayout.addRow("Band preset: ", self.preset)
+
+    self.loadPresetsButton = qt.QPushButton("Load band presets...")
+    self.loadPresetsButton.toolTip = "Add the presets in a JSON file to the list."
+    parametersFormLayout.addRow(self.loadPresetsButton)
+
+    # optional per-frame statistics
+    self.stats = slicer.qMRMLNodeComboBox()
+    self.stats.nodeTypes = ["vtkMRMLTableNode"]
+    self.stats.selectNodeUponCreation = True
+    self.stats.addEnabled = True
+    self.stats.removeEnabled = False
+    self.stats.noneEnabled = True
+    self.stats.renameEnabled = True
+    self.stats.showHidden = False
+    self.stats.showChildNodeTypes = False
+    self.stats.setMRMLScene( slicer.mrmlScene )
+    self.stats.setToolTip( "Pick a table for the volume of each class in each frame, or None to skip." )
+    parametersFormLayout.addRow("Statistics Table: ", self.stats)
+
+    self.incremental = qt.QCheckBox()
+    self.incremental.setChecked(False)
+    self.incremental.setToolTip( "Only reclassify slabs whose input or mask changed since the last incremental run into the same output." )
+    parametersFormLayout.addRow("Incremental: ", self.incremental)
+
     #
     # Apply Button
     #
@@ -113,9 +189,13 @@ class AtelectSegmentWidget(ScriptedLoadableModuleWidget):
 
     # connections
     self.applyButton.connect('clicked(bool)', self.onApplyButton)
+    self.loadPresetsButton.connect('clicked(bool)', self.onLoadPresets)
     self.inputSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.onSelect)
     self.ovol.connect("currentNodeChanged(vtkMRMLNode*)", self.onSelect)
 
+    self.presets = AtelectSegmentLogic().loadPresets()
+    self.updatePresets()
+
     # Add vertical spacer
     self.layout.addStretch(1)
 
@@ -128,9 +208,27 @@ class AtelectSegmentWidget(ScriptedLoadableModuleWidget):
   def onSelect(self):
     self.applyButton.enabled = (self.inputSelector.currentNode() is not None) & (self.ovol.currentNode() is not None)
 
+  def updatePresets(self):
+    current = self.preset.currentText
+    self.preset.clear()
+    self.preset.addItem('Automatic')
+    for name in sorted(self.presets):
+      self.preset.addItem(name)
+    index = self.preset.findText(current)
+    self.preset.setCurrentIndex(index if index >= 0 else 0)
+
+  def onLoadPresets(self):
+    fname = qt.QFileDialog.getOpenFileName(None, 'Load Band Presets', '', 'JSON files (*.json)')
+    if fname:
+      self.presets = AtelectSegmentLogic().loadPresets(fname)
+      self.updatePresets()
+
   def onApplyButton(self):
     logic = AtelectSegmentLogic()
-    logic.run(self.inputSelector.currentNode(), self.imask.currentNode(), self.ovol.currentNode(), self.progbar)
+    preset = None
+    if self.preset.currentIndex > 0:
+      preset = self.presets[self.preset.currentText]
+    logic.run(self.inputSelector.currentNode(), self.imask.currentNode(), self.ovol.currentNode(), self.progbar, int(self.chunk.text), self.stats.currentNode(), preset=preset, incremental=self.incremental.isChecked())
 
 #
 # pig_dynLogic
@@ -146,9 +244,273 @@ class AtelectSegmentLogic(ScriptedLoadableModuleLogic):
   https://github.com/Slicer/Slicer/blob/master/Base/Python/slicer/ScriptedLoadableModule.py
   """
 
-  def run(self, input_vol, input_mask, output_vol, pb = None):
+  def bands(self, scalar_type):
+    """The (edges, classes, right) band definition for a VTK scalar type, as
+    taken by classify
+    """
+    # if floating point, assume bounded 0 to 1.0
+    if scalar_type == vtk.VTK_FLOAT:
+      return FRACTION_EDGES, FRACTION_CLASSES, False
+    return HU_EDGES, HU_CLASSES, True
+
+  def loadPresets(self, fname = DEFAULT_PRESETS_FILE):
+    """Return the built in band presets together with those in a JSON file,
+    which override built in presets of the same name.  The file maps preset
+    names to objects with "edges", "classes" and "right" members as in
+    BUILTIN_PRESETS; a missing default file is ignored.
+    """
+    presets = dict(BUILTIN_PRESETS)
+    if fname == DEFAULT_PRESETS_FILE and not os.path.exists(fname):
+      return presets
+    f = open(fname, 'r')
+    contents = json.load(f)
+    f.close()
+    for name, preset in contents.items():
+      presets[name] = self.checkPreset(name, preset['edges'], preset['classes'], preset.get('right', True))
+    return presets
+
+  def checkPreset(self, name, edges, classes, right):
+    """Validate a band preset and return it as (edges, classes, right)
+    """
+    edges = tuple(edges)
+    classes = tuple(int(c) for c in classes)
+    if len(classes) != len(edges) + 1:
+      raise ValueError('band preset %s needs one more class than edges' % name)
+    if any(edges[i] >= edges[i + 1] for i in range(0, len(edges) - 1)):
+      raise ValueError('band preset %s has edges which do not increase' % name)
+    if any(c < 0 or c > 255 for c in classes):
+      raise ValueError('band preset %s has classes outside 0 to 255' % name)
+    return edges, classes, bool(right)
+
+  def lookupTable(self, dtype, edges, classes, right):
+    """Return the class of every value of an 8 or 16 bit integer dtype as a
+    uint8 table indexed by the values viewed as unsigned.  Tables are
+    compiled once per session and shared, so must not be modified.
+    """
+    dtype = np.dtype(dtype)
+    key = ('lut', dtype.str, tuple(edges), tuple(classes), bool(right))
+    if key not in _compiledBands:
+      values = np.arange(1 << (8 * dtype.itemsize)).astype('u%d' % dtype.itemsize).view(dtype)
+      lut = np.asarray(classes, dtype=np.uint8)[np.digitize(values, edges, right)]
+      lut.flags.writeable = False
+      _compiledBands[key] = lut
+    return _compiledBands[key]
+
+  def digitizeBands(self, dtype, edges, classes):
+    """Return the edges at the precision of dtype, if floating point, and the
+    classes as uint8, as used by classify for input without a lookup table.
+    Compiled once per session like lookupTable.
+    """
+    dtype = np.dtype(dtype)
+    key = ('digitize', dtype.str, tuple(edges), tuple(classes))
+    if key not in _compiledBands:
+      edge_array = np.asarray(edges, dtype=dtype if dtype.kind == 'f' else None)
+      class_array = np.asarray(classes, dtype=np.uint8)
+      edge_array.flags.writeable = False
+      class_array.flags.writeable = False
+      _compiledBands[key] = (edge_array, class_array)
+    return _compiledBands[key]
+
+  def hasLookupTable(self, dtype):
+    """Whether classify uses a lookup table for input of dtype
+    """
+    return np.dtype(dtype).kind in 'iu' and np.dtype(dtype).itemsize <= 2
+
+  def classify(self, a, edges, classes, right, mask = None, out = None, lut = None):
+    """Return the uint8 class of every voxel of a, with voxels where mask is
+    0 set to class 0.  8 and 16 bit integer input is classified with a
+    single gather from a lookup table, which is built unless passed as lut;
+    anything else is binned with digitize.
+    """
+    if out is None:
+      out = np.empty(a.shape, dtype=np.uint8)
+    if self.hasLookupTable(a.dtype):
+      if lut is None:
+        lut = self.lookupTable(a.dtype, edges, classes, right)
+      np.take(lut, a.view('u%d' % a.dtype.itemsize), out=out, mode='clip')
+    else:
+      edge_array, class_array = self.digitizeBands(a.dtype, edges, classes)
+      np.take(class_array, np.digitize(a, edge_array, right), out=out, mode='clip')
+    if mask is not None:
+      np.multiply(out, mask != 0, out=out)
+    return out
+
+  def classifyVolume(self, a, edges, classes, right, mask = None, out = None, slices_per_chunk = DEFAULT_SLICES_PER_CHUNK, threads = None, pb = None, counts = None, chunks = None):
+    """As classify for a [z][y][x] volume, but in chunks of slices_per_chunk
+    slices on a pool of threads, writing into out.  Only the temporaries of the
+    chunks in progress are held at once.  Progress is reported from the
+    calling thread as each chunk completes.  If counts is given, row z is
+    filled with the number of voxels of each class in slice z while the slice
+    is still in cache.  If chunks is given, only the chunks with those indices
+    are classified and out is left as it is elsewhere.  With a mask, only the
+    voxels within its bounding box are classified and the rest set to 0.
+    """
+    if threads is None:
+      threads = os.cpu_count() or 1
+    if out is None:
+      out = np.empty(a.shape, dtype=np.uint8)
+    lut = None
+    if self.hasLookupTable(a.dtype):
+      lut = self.lookupTable(a.dtype, edges, classes, right)
+    bounds = ((0, 0), (0, 0), (0, 0))
+    if mask is None:
+      bounds = tuple((0, n) for n in a.shape)
+    elif mask.any():
+      bounds = self.maskBounds(mask)
+    (z_min, z_max), (y_min, y_max), (x_min, x_max) = bounds
+
+    def classify_chunk(z, z_end, reclassify = True):
+      if reclassify:
+        # zero around the box, then classify only inside it
+        z_start = min(max(z, z_min), z_end)
+        z_stop = max(min(z_end, z_max), z_start)
+        out[z:z_start] = 0
+        out[z_stop:z_end] = 0
+        out[z_start:z_stop, :y_min] = 0
+        out[z_start:z_stop, y_max:] = 0
+        out[z_start:z_stop, y_min:y_max, :x_min] = 0
+        out[z_start:z_stop, y_min:y_max, x_max:] = 0
+        if z_stop > z_start:
+          box = (slice(z_start, z_stop), slice(y_min, y_max), slice(x_min, x_max))
+          self.classify(a[box], edges, classes, right, None if mask is None else mask[box], out[box], lut)
+      if counts is not None:
+        for zs in range(z, z_end):
+          counts[zs] = np.bincount(out[zs].ravel(), minlength=counts.shape[1])
+      return z_end - z
+
+    max_z = len(a)
+    pool = ThreadPoolExecutor(max_workers=threads)
+    try:
+      futures = []
+      for z in range(0, max_z, slices_per_chunk):
+        reclassify = chunks is None or z // slices_per_chunk in chunks
+        if reclassify or counts is not None:
+          futures.append(pool.submit(classify_chunk, z, min(z + slices_per_chunk, max_z), reclassify))
+      done = 0
+      for future in as_completed(futures):
+        done += future.result()
+        if pb is None:
+          pass
+        else:
+          pb.setValue(done * 100 // max_z)
+          slicer.app.processEvents()
+    finally:
+      pool.shutdown()
+    return out
+
+  def maskBounds(self, mask):
+    """Return the tight ((z_min, z_max), (y_min, y_max), (x_min, x_max)) box,
+    maximum exclusive, around the non-zero voxels of a [z][y][x] mask, found
+    from any() projections of the mask onto each axis.  The mask must not be
+    empty.
+    """
+    slices = mask.any(axis=0)
+    bounds = []
+    for projection in (mask.any(axis=(1, 2)), slices.any(axis=1), slices.any(axis=0)):
+      indices = np.flatnonzero(projection)
+      bounds.append((int(indices[0]), int(indices[-1]) + 1))
+    return tuple(bounds)
+
+  def slabDigests(self, a, mask, slices_per_chunk = DEFAULT_SLICES_PER_CHUNK, threads = None):
+    """Return a checksum of the input and mask of each chunk of
+    slices_per_chunk slices, computed on a pool of threads
+    """
+    if threads is None:
+      threads = os.cpu_count() or 1
+
+    def digest(z):
+      crc = zlib.crc32(np.ascontiguousarray(a[z:z + slices_per_chunk]).data)
+      if mask is not None:
+        crc = zlib.crc32(np.ascontiguousarray(mask[z:z + slices_per_chunk]).data, crc)
+      return '%08x' % (crc & 0xffffffff)
+
+    pool = ThreadPoolExecutor(max_workers=threads)
+    try:
+      return list(pool.map(digest, range(0, len(a), slices_per_chunk)))
+    finally:
+      pool.shutdown()
+
+  def digestLayout(self, a, mask, preset, slices_per_chunk):
+    """Describe everything other than voxel values which the output of a run
+    depends on, so digests are only compared between like runs
+    """
+    return json.dumps([list(a.shape), a.dtype.str, mask is not None, [list(preset[0]), list(preset[1]), bool(preset[2])], slices_per_chunk])
+
+  def outputStamp(self, imageData):
+    """Identify the state of the output image data, as stored with the digests
+    so that an output edited or replaced since is classified again
+    """
+    return [imageData.GetMTime(), SESSION_TOKEN]
+
+  def changedChunks(self, previous, layout, digests, output = None):
+    """Return the indices of the chunks whose digests differ from those stored
+    in previous by an earlier run, or None if everything must be classified.
+    output is the outputStamp of the output image data, which must be as the
+    earlier run left it.
+    """
+    if previous is None:
+      return None
+    previous = json.loads(previous)
+    if previous['layout'] != layout or previous.get('output') != output or len(previous['digests']) != len(digests):
+      return None
+    return set(i for i in range(0, len(digests)) if digests[i] != previous['digests'][i])
+
+  def frameCounts(self, slice_counts, slices_per_frame, padded):
+    """Sum per-slice class counts into per-frame counts, leaving out the
+    padding MVTConvert adds: the first slice and all slices after the last
+    whole frame
+    """
+    offset = 1 if padded else 0
+    nframes = len(slice_counts) // slices_per_frame - 2 * offset
+    frames = slice_counts[offset:offset + nframes * slices_per_frame]
+    return frames.reshape(nframes, slices_per_frame, -1).sum(axis=1)
+
+  def frameStatistics(self, frame_counts, spacing):
+    """Rows of STATISTICS_COLUMNS for each frame and class other than
+    background.  The fraction is of all classified voxels in the frame.
+    """
+    voxel_ml = float(np.prod(spacing)) / 1000.0
+    rows = []
+    for frame in range(0, len(frame_counts)):
+      total = frame_counts[frame][1:].sum()
+      for c in range(1, len(frame_counts[frame])):
+        count = int(frame_counts[frame][c])
+        name = CLASS_NAMES[c] if c < len(CLASS_NAMES) else '%d' % c
+        rows.append((frame, c, name, count, count * voxel_ml, float(count) / total if total > 0 else 0.0))
+    return rows
+
+  def writeStatistics(self, fname, rows):
+    """Write rows from frameStatistics to a CSV file
+    """
+    f = open(fname, 'w')
+    f.write(','.join(STATISTICS_COLUMNS) + '\n')
+    for row in rows:
+      f.write('%d,%d,%s,%d,%f,%f\n' % row)
+    f.close()
+
+  def fillStatisticsTable(self, table_node, rows):
+    """Replace the contents of a table node with rows from frameStatistics
     """
-    Run the actual algorithm
+    arrays = (vtk.vtkIntArray(), vtk.vtkIntArray(), vtk.vtkStringArray(), vtk.vtkIntArray(), vtk.vtkDoubleArray(), vtk.vtkDoubleArray())
+    for col, arr in enumerate(arrays):
+      arr.SetName(STATISTICS_COLUMNS[col])
+      arr.SetNumberOfValues(len(rows))
+      for r, row in enumerate(rows):
+        arr.SetValue(r, row[col])
+    table_node.RemoveAllColumns()
+    for arr in arrays:
+      table_node.AddColumn(arr)
+    table_node.Modified()
+
+  def run(self, input_vol, input_mask, output_vol, pb = None, slices_per_chunk = DEFAULT_SLICES_PER_CHUNK, stats_table = None, stats_fname = None, preset = None, incremental = False):
+    """
+    Run the actual algorithm.  If stats_table or stats_fname is given, the
+    count, volume and fraction of each class in each frame is accumulated
+    while classifying and written to that table node or CSV file.  preset is
+    an (edges, classes, right) band definition from loadPresets; by default
+    the Gattinoni bands for the input type are used.  If incremental, slab
+    digests are stored on output_vol and a later incremental run into the
+    same output only reclassifies the slabs whose input or mask changed.
     """
 
     logging.info('Processing started')
@@ -175,46 +537,55 @@ class AtelectSegmentLogic(ScriptedLoadableModuleLogic):
     imageSize=[max_x, max_y, max_z]
     imageSpacing=input_vol.GetSpacing()
     voxelType=input_vol.GetImageData().GetScalarType()
-    # Create an empty image volume
-    imageData=vtk.vtkImageData()
-    #imageData.DeepCopy(input_vol.GetImageData())
-    imageData.SetDimensions(max_x, max_y, max_z)
-    imageData.AllocateScalars(vtk.VTK_SHORT, 1)
+    previous = output_vol.GetAttribute(DIGESTS_ATTRIBUTE) if incremental else None
+    imageData = output_vol.GetImageData()
+    if (previous is None or imageData is None or list(imageData.GetDimensions()) != imageSize
+        or imageData.GetScalarType() != vtk.VTK_UNSIGNED_CHAR):
+      previous = None
+      # Create an empty image volume
+      imageData=vtk.vtkImageData()
+      #imageData.DeepCopy(input_vol.GetImageData())
+      imageData.SetDimensions(max_x, max_y, max_z)
+      # classes 0 to 4 only need one byte per voxel
+      imageData.AllocateScalars(vtk.VTK_UNSIGNED_CHAR, 1)
 
     output_scalars = imageData.GetPointData().GetScalars()
     da = vtk.util.numpy_support.vtk_to_numpy(output_scalars).reshape(input_shape)
     #da = slicer.util.array(volumeNode.GetID())
 
-    o = np.zeros_like(a)
-
-    # if floating point, assume bounded 0 to 1.0
-    if input_im.GetScalarType() == vtk.VTK_FLOAT:
-      o[np.where((a >= 0) & (a < 0.1))] = 1
-      o[np.where((a >= 0.1) & (a < 0.5))] = 2
-      o[np.where((a >= 0.5) & (a < 0.9))] = 3
-      o[np.where((a >= 0.9) & (a <= 1.0))] = 4
-    else:
-      o[np.where((a > -100) & (a <= 100))] = 1
-      o[np.where((a > -500) & (a <= -100))] = 2
-      o[np.where((a > -900) & (a <= -500))] = 3
-      o[np.where((a > -1000) & (a <= -900))] = 4
-
     # mask if requested
+    b = None
     if input_mask is not None:
       im_im = input_mask.GetImageData()
       b = vtk.util.numpy_support.vtk_to_numpy(im_im.GetPointData().GetScalars()).reshape(input_shape)
-      o[np.where(b == 0)] = 0
 
-    da[:,:,:] = o
+    if preset is None:
+      preset = self.bands(input_im.GetScalarType())
+    edges, classes, right = preset
+
+    chunks = None
+    if incremental:
+      layout = self.digestLayout(a, b, preset, slices_per_chunk)
+      digests = self.slabDigests(a, b, slices_per_chunk)
+      chunks = self.changedChunks(previous, layout, digests, self.outputStamp(imageData))
+      logging.info('Reclassifying %s of %d slabs' % ('all' if chunks is None else '%d' % len(chunks), len(digests)))
+
+    counts = None
+    if stats_table is not None or stats_fname is not None:
+      counts = np.zeros((max_z, max(len(CLASS_NAMES), max(classes) + 1)), dtype=np.int64)
+    self.classifyVolume(a, edges, classes, right, b, da, slices_per_chunk, pb=pb, counts=counts, chunks=chunks)
+
+    if counts is not None:
+      slices_per_frame, padded = MVTConvertLogic().frameLayout(input_vol)
+      rows = self.frameStatistics(self.frameCounts(counts, slices_per_frame, padded), input_vol.GetSpacing())
+      if stats_table is not None:
+        self.fillStatisticsTable(stats_table, rows)
+      if stats_fname is not None:
+        self.writeStatistics(stats_fname, rows)
         
     imageData.Modified()
     output_scalars.Modified()
     
-    thresholder=vtk.vtkImageThreshold()
-    thresholder.SetInputData(imageData)
-    thresholder.Update()
-    #thresholder.SetInValue(0)
-    #thresholder.SetOutValue(0)
     # Create volume node
     volumeNode = output_vol
     volumeNode.SetSpacing(imageSpacing)
@@ -222,7 +593,7 @@ class AtelectSegmentLogic(ScriptedLoadableModuleLogic):
     vm = vtk.vtkMatrix4x4()
     input_vol.GetIJKToRASDirectionMatrix(vm)
     volumeNode.SetIJKToRASDirectionMatrix(vm)
-    volumeNode.SetImageDataConnection(thresholder.GetOutputPort())
+    volumeNode.SetAndObserveImageData(imageData)
     # Add volume to scene
     displayNode=slicer.vtkMRMLLabelMapVolumeDisplayNode()
     slicer.mrmlScene.AddNode(displayNode)
@@ -255,6 +626,13 @@ class AtelectSegmentLogic(ScriptedLoadableModuleLogic):
     volumeNode.CreateDefaultStorageNode()
     
     logging.info('Processing completed %d %d' % (imageData.GetScalarRange()[0], imageData.GetScalarRange()[1]))
+
+    # stored last, so the stamp is of the output as this run leaves it
+    if incremental:
+      output_vol.SetAttribute(DIGESTS_ATTRIBUTE, json.dumps({'layout': layout, 'digests': digests, 'output': self.outputStamp(imageData)}))
+    else:
+      output_vol.RemoveAttribute(DIGESTS_ATTRIBUTE)
+
     if pb is None:
       pass
     else:
@@ -287,6 +665,11 @@ class AtelectSegmentTest(ScriptedLoadableModuleTest):
     """
     self.setUp()
     self.test_AtelectSegment1()
+    self.test_AtelectSegmentClassify()
+    self.test_AtelectSegmentStatistics()
+    self.test_AtelectSegmentPresets()
+    self.test_AtelectSegmentIncremental()
+    self.test_AtelectSegmentMaskBounds()
 
   def test_AtelectSegment1(self):
     """ Ideally you should have several levels of tests.  At the lowest level
@@ -323,3 +706,202 @@ class AtelectSegmentTest(ScriptedLoadableModuleTest):
     logic = pig_dynLogic()
     self.assertTrue( logic.hasImageData(volumeNode) )
     self.delayDisplay('Test passed!')
+
+  def test_AtelectSegmentClassify(self):
+    """ Check the lookup table and digitize classifiers against thresholding
+    each band in turn.
+    """
+
+    self.delayDisplay("Starting the classifier test")
+
+    def reference(a, fraction):
+      o = np.zeros(a.shape, dtype=np.uint8)
+      if fraction:
+        o[(a >= 0) & (a < 0.1)] = 1
+        o[(a >= 0.1) & (a < 0.5)] = 2
+        o[(a >= 0.5) & (a < 0.9)] = 3
+        o[(a >= 0.9) & (a <= 1.0)] = 4
+      else:
+        o[(a > -100) & (a <= 100)] = 1
+        o[(a > -500) & (a <= -100)] = 2
+        o[(a > -900) & (a <= -500)] = 3
+        o[(a > -1000) & (a <= -900)] = 4
+      return o
+
+    rs = np.random.RandomState(18)
+    logic = AtelectSegmentLogic()
+    mask = rs.randint(0, 3, size=(4, 6, 5)).astype(np.uint8)
+    edge_hu = np.array([-1001, -1000, -999, -901, -900, -899, -501, -500, -499, -101, -100, -99, 99, 100, 101, -32768, 32767])
+    edge_fraction = np.array([-0.01, 0.0, 0.0999, 0.1, 0.4999, 0.5, 0.8999, 0.9, 1.0, 1.0001, np.nan])
+
+    for dtype, scalar_type, edge_values in ((np.int16, vtk.VTK_SHORT, edge_hu), (np.int32, vtk.VTK_INT, edge_hu), (np.float32, vtk.VTK_FLOAT, edge_fraction)):
+      if scalar_type == vtk.VTK_FLOAT:
+        a = rs.uniform(-0.1, 1.1, size=mask.shape).astype(dtype)
+      else:
+        a = rs.randint(-1200, 200, size=mask.shape).astype(dtype)
+      a.flat[:len(edge_values)] = edge_values
+
+      edges, classes, right = logic.bands(scalar_type)
+      expected = reference(a, scalar_type == vtk.VTK_FLOAT)
+      self.assertTrue(np.array_equal(logic.classify(a, edges, classes, right), expected))
+      self.assertTrue(np.array_equal(logic.classify(a, edges, classes, right, mask), np.where(mask == 0, 0, expected)))
+
+      # straight into a preallocated label image buffer
+      out = np.full(mask.shape, 255, dtype=np.uint8)
+      self.assertTrue(logic.classify(a, edges, classes, right, mask, out) is out)
+      self.assertTrue(np.array_equal(out, np.where(mask == 0, 0, expected)))
+
+      # in chunks of slices on several threads, including a short final chunk
+      out.fill(255)
+      logic.classifyVolume(a, edges, classes, right, mask, out, slices_per_chunk=3, threads=2)
+      self.assertTrue(np.array_equal(out, np.where(mask == 0, 0, expected)))
+
+    self.delayDisplay('Test passed!')
+
+  def test_AtelectSegmentStatistics(self):
+    """ Check the per-frame class counts gathered while classifying.
+    """
+
+    self.delayDisplay("Starting the per-frame statistics test")
+
+    rs = np.random.RandomState(21)
+    logic = AtelectSegmentLogic()
+    slices_per_frame, nframes = 2, 3
+    # padded as MVTConvert does: one slice before the frames, the rest after
+    a = rs.randint(-1200, 200, size=(slices_per_frame * (nframes + 2), 6, 5)).astype(np.int16)
+    mask = rs.randint(0, 2, size=a.shape).astype(np.uint8)
+
+    counts = np.zeros((len(a), len(CLASS_NAMES)), dtype=np.int64)
+    edges, classes, right = logic.bands(vtk.VTK_SHORT)
+    out = logic.classifyVolume(a, edges, classes, right, mask, slices_per_chunk=3, threads=2, counts=counts)
+    frame_counts = logic.frameCounts(counts, slices_per_frame, True)
+    self.assertEqual(frame_counts.shape, (nframes, len(CLASS_NAMES)))
+    for frame in range(0, nframes):
+      frame_out = out[1 + frame * slices_per_frame:1 + (frame + 1) * slices_per_frame]
+      self.assertTrue(np.array_equal(frame_counts[frame], np.bincount(frame_out.ravel(), minlength=len(CLASS_NAMES))))
+    self.assertTrue(np.array_equal(logic.frameCounts(counts, 1, False), counts))
+
+    rows = logic.frameStatistics(frame_counts, (0.5, 0.5, 2.0))
+    self.assertEqual(len(rows), nframes * 4)
+    frame, c, name, count, volume, fraction = rows[5]
+    self.assertEqual((frame, c, name, count), (1, 2, 'Poorly Aerated', frame_counts[1][2]))
+    self.assertAlmostEqual(volume, count * 0.5 / 1000.0)
+    self.assertAlmostEqual(sum(row[5] for row in rows[4:8]), 1.0)
+
+    fname = slicer.app.temporaryPath + '/AtelectSegmentStatistics.csv'
+    logic.writeStatistics(fname, rows)
+    lines = open(fname).read().splitlines()
+    self.assertEqual(lines[0], 'frame,class,name,count,volume_ml,fraction')
+    self.assertEqual(len(lines), len(rows) + 1)
+    self.delayDisplay('Test passed!')
+
+  def test_AtelectSegmentPresets(self):
+    """ Check band presets load from a file and compile once.
+    """
+
+    self.delayDisplay("Starting the band preset test")
+
+    logic = AtelectSegmentLogic()
+    fname = slicer.app.temporaryPath + '/AtelectSegmentBands.json'
+    f = open(fname, 'w')
+    json.dump({
+      'Coarse': {'edges': [-1000, -500, 100], 'classes': [0, 2, 1, 0], 'right': True},
+      'Gattinoni HU': {'edges': [-1000, -900, -500, -100, 0], 'classes': [0, 4, 3, 2, 1, 0]},
+      }, f)
+    f.close()
+
+    presets = logic.loadPresets(fname)
+    self.assertEqual(presets['Gattinoni fraction'], BUILTIN_PRESETS['Gattinoni fraction'])
+    self.assertEqual(presets['Gattinoni HU'][0][-1], 0)
+    self.assertEqual(logic.loadPresets(), BUILTIN_PRESETS)
+
+    a = np.array([[[-1001, -1000, -999, -500, -499, 100, 101]]], dtype=np.int16)
+    edges, classes, right = presets['Coarse']
+    self.assertEqual(list(logic.classify(a, edges, classes, right).ravel()), [0, 0, 2, 2, 1, 1, 0])
+    self.assertEqual(list(logic.classify(a.astype(np.float64), edges, classes, right).ravel()), [0, 0, 2, 2, 1, 1, 0])
+
+    # compiled once and shared between runs
+    self.assertTrue(logic.lookupTable(np.int16, edges, classes, right) is logic.lookupTable(np.int16, list(edges), classes, right))
+    self.assertTrue(logic.digitizeBands(np.float32, edges, classes) is logic.digitizeBands(np.float32, edges, classes))
+    self.assertFalse(logic.lookupTable(np.int16, edges, classes, right) is logic.lookupTable(np.int16, edges, classes, False))
+
+    self.assertRaises(ValueError, logic.checkPreset, 'bad', [0, 1], [0, 1], True)
+    self.assertRaises(ValueError, logic.checkPreset, 'bad', [1, 0], [0, 1, 0], True)
+    self.assertRaises(ValueError, logic.checkPreset, 'bad', [0, 1], [0, 256, 0], True)
+    self.delayDisplay('Test passed!')
+
+  def test_AtelectSegmentIncremental(self):
+    """ Check only slabs whose input or mask changed are reclassified.
+    """
+
+    self.delayDisplay("Starting the incremental classification test")
+
+    rs = np.random.RandomState(23)
+    logic = AtelectSegmentLogic()
+    a = rs.randint(-1200, 200, size=(10, 6, 5)).astype(np.int16)
+    mask = rs.randint(0, 2, size=a.shape).astype(np.uint8)
+    preset = BUILTIN_PRESETS['Gattinoni HU']
+    edges, classes, right = preset
+
+    layout = logic.digestLayout(a, mask, preset, 3)
+    digests = logic.slabDigests(a, mask, 3, threads=2)
+    self.assertEqual(len(digests), 4)
+    out = logic.classifyVolume(a, edges, classes, right, mask, slices_per_chunk=3)
+    stored = json.dumps({'layout': layout, 'digests': digests, 'output': [7, SESSION_TOKEN]})
+    self.assertEqual(logic.changedChunks(None, layout, digests, [7, SESSION_TOKEN]), None)
+    self.assertEqual(logic.changedChunks(stored, layout, digests, [7, SESSION_TOKEN]), set())
+
+    # an output edited since, or left by another process, is classified again
+    self.assertEqual(logic.changedChunks(stored, layout, digests, [8, SESSION_TOKEN]), None)
+    self.assertEqual(logic.changedChunks(stored, layout, digests, [7, 'another session']), None)
+
+    # edit the mask in slice 4 and the input in slice 9
+    mask[4, 2, 2] = 1 - mask[4, 2, 2]
+    a[9, 0, 0] = -950 if a[9, 0, 0] > -900 else 0
+    digests = logic.slabDigests(a, mask, 3)
+    chunks = logic.changedChunks(stored, layout, digests, [7, SESSION_TOKEN])
+    self.assertEqual(chunks, set([1, 3]))
+
+    # unchanged slabs are left alone, changed ones are brought up to date
+    out[0:3] = 4
+    counts = np.zeros((len(a), len(CLASS_NAMES)), dtype=np.int64)
+    logic.classifyVolume(a, edges, classes, right, mask, out, slices_per_chunk=3, counts=counts, chunks=chunks)
+    expected = logic.classify(a, edges, classes, right, mask)
+    self.assertTrue((out[0:3] == 4).all())
+    self.assertEqual(counts[0:3, 4].sum(), out[0:3].size)
+    self.assertTrue(np.array_equal(out[3:], expected[3:]))
+    self.assertTrue(np.array_equal(counts[3:].sum(axis=0), np.bincount(expected[3:].ravel(), minlength=len(CLASS_NAMES))))
+
+    # any change of layout classifies everything again
+    self.assertEqual(logic.changedChunks(stored, logic.digestLayout(a, mask, preset, 4), digests, [7, SESSION_TOKEN]), None)
+    self.assertEqual(logic.changedChunks(stored, logic.digestLayout(a, None, preset, 3), digests, [7, SESSION_TOKEN]), None)
+    self.delayDisplay('Test passed!')
+
+  def test_AtelectSegmentMaskBounds(self):
+    """ Check classification is confined to the mask's bounding box.
+    """
+
+    self.delayDisplay("Starting the mask bounding box test")
+
+    rs = np.random.RandomState(24)
+    logic = AtelectSegmentLogic()
+    a = rs.randint(-1200, 200, size=(9, 8, 7)).astype(np.int16)
+    edges, classes, right = BUILTIN_PRESETS['Gattinoni HU']
+
+    mask = np.zeros(a.shape, dtype=np.uint8)
+    mask[2, 3, 4] = 1
+    mask[5, 6, 1] = 2
+    mask[4, 2, 2] = 1
+    self.assertEqual(logic.maskBounds(mask), ((2, 6), (2, 7), (1, 5)))
+
+    expected = logic.classify(a, edges, classes, right, mask)
+    for slices_per_chunk in (1, 2, 4, 9):
+      out = np.full(a.shape, 255, dtype=np.uint8)
+      logic.classifyVolume(a, edges, classes, right, mask, out, slices_per_chunk, threads=2)
+      self.assertTrue(np.array_equal(out, expected))
+
+    # an empty mask classifies nothing
+    out = np.full(a.shape, 255, dtype=np.uint8)
+    logic.classifyVolume(a, edges, classes, right, np.zeros_like(mask), out, 4)
+    self.assertFalse(out.any())
+    self.delayDisplay('Test passed!')
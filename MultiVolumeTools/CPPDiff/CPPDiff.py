@@ -156,6 +156,20 @@ class CPPDiffLogic(ScriptedLoadableModuleLogic):
   https://github.com/Slicer/Slicer/blob/master/Base/Python/slicer/ScriptedLoadableModule.py
   """
 
+  def displacement(self, idata, ijkToRas, dr, da, ds):
+    """Fill dr, da and ds with the R, A and S components of the [z][y][x][3]
+    point data idata less the RAS position of each voxel under the 4x4
+    IJK to RAS matrix.  The RAS grid is never built: each component is the sum
+    of one row per axis, subtracted in place with broadcasting.
+    """
+    m = np.asarray(ijkToRas, dtype=np.float64)
+    max_z, max_y, max_x = idata.shape[:3]
+    for c, out in enumerate((dr, da, ds)):
+      np.copyto(out, idata[:, :, :, c], casting='unsafe')
+      out -= (m[c, 2] * np.arange(max_z) + m[c, 3]).reshape(max_z, 1, 1).astype(out.dtype)
+      out -= (m[c, 1] * np.arange(max_y)).reshape(max_y, 1).astype(out.dtype)
+      out -= (m[c, 0] * np.arange(max_x)).astype(out.dtype)
+
   def run(self, input_vol, r, a, s, pb = None):
     """
     Run the actual algorithm
@@ -207,21 +221,7 @@ class CPPDiffLogic(ScriptedLoadableModuleLogic):
     ds = vtk.util.numpy_support.vtk_to_numpy(output_scalarsS).reshape([max_z, max_y, max_x])
 
     # put in the actual data
-    for z in xrange(0, max_z):
-      for y in xrange(0, max_y):
-        for x in xrange(0, max_x):
-          ijkcoord = (x, y, z, 1.0)
-          rascoord = mtform.MultiplyPoint(ijkcoord)
-
-          dr[z,y,x] = idata[z,y,x,0] - rascoord[0]
-          da[z,y,x] = idata[z,y,x,1] - rascoord[1]
-          ds[z,y,x] = idata[z,y,x,2] - rascoord[2]
-      
-      if pb is None:
-        pass
-      else:
-        pb.setValue(100 * z / max_z)
-        slicer.app.processEvents()
+    self.displacement(idata, [[mtform.GetElement(i, j) for j in range(0, 4)] for i in range(0, 4)], dr, da, ds)
 
     # normalize to mean movement (i.e. similar to centre of lung)
     #dr[:,:,:] = dr[:,:,:] - np.mean(dr)
@@ -328,6 +328,7 @@ class CPPDiffTest(ScriptedLoadableModuleTest):
     """
     self.setUp()
     self.test_CPPDiff1()
+    self.test_CPPDiffDisplacement()
 
   def test_CPPDiff1(self):
     """ Ideally you should have several levels of tests.  At the lowest level
@@ -364,3 +365,26 @@ class CPPDiffTest(ScriptedLoadableModuleTest):
     logic = pig_dynLogic()
     self.assertTrue( logic.hasImageData(volumeNode) )
     self.delayDisplay('Test passed!')
+
+  def test_CPPDiffDisplacement(self):
+    """ Check the broadcast displacement against transforming each voxel.
+    """
+
+    self.delayDisplay("Starting the displacement test")
+
+    rs = np.random.RandomState(25)
+    max_z, max_y, max_x = 4, 5, 6
+    idata = rs.uniform(-200, 200, size=(max_z, max_y, max_x, 3)).astype(np.float32)
+    m = np.array([[-0.7, 0.0, 0.1, 120.5], [0.0, -0.7, 0.0, 95.25], [0.05, 0.0, 1.25, -310.0], [0.0, 0.0, 0.0, 1.0]])
+
+    expected = np.zeros(idata.shape, dtype=np.float32)
+    for z in range(0, max_z):
+      for y in range(0, max_y):
+        for x in range(0, max_x):
+          expected[z, y, x] = idata[z, y, x] - m.dot((x, y, z, 1.0))[:3]
+
+    dr, da, ds = [np.empty((max_z, max_y, max_x), dtype=np.float32) for c in range(0, 3)]
+    CPPDiffLogic().displacement(idata, m, dr, da, ds)
+    for c, out in enumerate((dr, da, ds)):
+      self.assertTrue(np.allclose(out, expected[:, :, :, c], rtol=1e-5, atol=1e-3))
+    self.delayDisplay('Test passed!')
@@ -2,8 +2,44 @@ import os
 import unittest
 import vtk, qt, ctk, slicer
 from slicer.ScriptedLoadableModule import *
-from struct import pack
+from struct import pack, unpack, unpack_from, calcsize
 import logging
+import time
+import json
+import hashlib
+import zlib
+import collections
+import functools
+from concurrent.futures import ThreadPoolExecutor, wait
+import numpy as np
+from MVTConvert import MVTConvertLogic, ConcatenatedFrames, SESSION_TOKEN
+
+# Default ceiling on the scratch buffers used while streaming an export
+DEFAULT_MAX_MEMORY = 64 * 1024 * 1024
+
+# Volume attributes stored as strings in the header, in file order
+HEADER_ATTRIBUTES = ('pig_dyn.SourceName', 'pig_dyn.AcquisitionDateTime', 'pig_dyn.SeriesName', 'pig_dyn.PatientName')
+
+# Version 2 files start with a magic number which reads as a NaN spacing to a
+#  version 1 parser, followed by the version and the payload encoding.  The
+#  version 1 header then follows unchanged, and after it the number of z slices
+#  per frame, the number of frames and a table of absolute '<q' byte offsets to
+#  the start of each frame.
+MVT_MAGIC = b'MVTBIN\xff\xff'
+MVT_VERSION = 2
+ENCODING_RAW = 0
+
+# Each frame is a separate zlib stream starting at its frame offset and ending
+#  at the next frame offset (or the end of the file for the last frame)
+ENCODING_ZLIB = 1
+DEFAULT_COMPRESSION_LEVEL = 6
+
+# Each frame stores only the voxels inside the label.  A frame is '<qq' run and
+#  value counts, then '<u2' arrays of the number of label runs in each row, the
+#  start column of each run and the length of each run, then the '<i2' values
+#  of the labelled voxels in order.  This is quicker to write than raw while
+#  the label covers less than about half of each slice.
+ENCODING_SPARSE = 2
 
 #
 # MVTBinaryExport
@@ -18,7 +54,7 @@ class MVTBinaryExport(ScriptedLoadableModule):
     ScriptedLoadableModule.__init__(self, parent)
     self.parent.title = "MVTBinaryExport" # TODO make this more human readable by adding spaces
     self.parent.categories = ["MultiVolumeTools"]
-    self.parent.dependencies = []
+    self.parent.dependencies = ["MVTConvert"]
     self.parent.contributors = ["John Cronin (KCL)"] # replace with "Firstname Lastname (Organization)"
     self.parent.helpText = """
     Export a Volume to a simple binary format.  Designed 
@@ -86,6 +122,33 @@ class MVTBinaryExportWidget(ScriptedLoadableModuleWidget):
     self.fname.text = '/tmp/analysis.bin'
     parametersFormLayout.addRow("Export to file: ", self.fname)
 
+    self.maxmem = qt.QLineEdit()
+    self.maxmem.text = '%d' % (DEFAULT_MAX_MEMORY // (1024 * 1024))
+    parametersFormLayout.addRow("Memory limit (MB): ", self.maxmem)
+
+    self.frameIndex = qt.QCheckBox()
+    self.frameIndex.setChecked(False)
+    self.frameIndex.setToolTip("Write a version 2 header with a table of per-frame offsets.")
+    parametersFormLayout.addRow("Write frame index: ", self.frameIndex)
+
+    # items are in the order of the ENCODING_ constants
+    self.encoding = qt.QComboBox()
+    self.encoding.addItem("Raw")
+    self.encoding.addItem("zlib compressed frames")
+    self.encoding.addItem("Sparse (labelled voxels only)")
+    self.encoding.setToolTip("Encoding of the voxel data.  Anything other than raw implies a frame index.")
+    parametersFormLayout.addRow("Encoding: ", self.encoding)
+
+    self.labels = qt.QLineEdit()
+    self.labels.text = '1'
+    self.labels.setToolTip("Comma separated label values to export.  With more than one label, a file is written for each, named e.g. analysis-2.bin.")
+    parametersFormLayout.addRow("Labels: ", self.labels)
+
+    self.force = qt.QCheckBox()
+    self.force.setChecked(False)
+    self.force.setToolTip("Rewrite files even if their manifest shows the volume, label map and settings are unchanged.")
+    parametersFormLayout.addRow("Force re-export: ", self.force)
+
     #
     # Apply Button
     #
@@ -93,6 +156,13 @@ class MVTBinaryExportWidget(ScriptedLoadableModuleWidget):
     self.applyButton.toolTip = "Run the algorithm."
     self.applyButton.enabled = False
     parametersFormLayout.addRow(self.applyButton)
+
+    #
+    # Batch Button
+    #
+    self.batchButton = qt.QPushButton("Export all series")
+    self.batchButton.toolTip = "Export every volume in the scene which has a matching -label map to the directory of the export file, in the background."
+    parametersFormLayout.addRow(self.batchButton)
     
     #
     # Progress Bar
@@ -103,6 +173,7 @@ class MVTBinaryExportWidget(ScriptedLoadableModuleWidget):
 
     # connections
     self.applyButton.connect('clicked(bool)', self.onApplyButton)
+    self.batchButton.connect('clicked(bool)', self.onBatchButton)
     self.inputSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.onSelect)
     self.inputLabelSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.onLabelSelect)
 
@@ -121,12 +192,56 @@ class MVTBinaryExportWidget(ScriptedLoadableModuleWidget):
   def onSelect(self):
     input_vol = self.inputSelector.currentNode()
     if((input_vol is not None) & (input_vol.GetAttribute('pig_dyn.AcquisitionDateTime') is not None)):
-      self.fname.text = '/tmp/analysis-' + input_vol.GetAttribute('pig_dyn.AcquisitionDateTime') + '.bin'
+      self.fname.text = MVTBinaryExportLogic().default_filename(input_vol, '/tmp')
     self.onLabelSelect()
 
+  def selectedLabels(self):
+    labels = [int(label) for label in self.labels.text.split(',') if label.strip()]
+    if labels == [1]:
+      return None
+    return labels
+
   def onApplyButton(self):
     logic = MVTBinaryExportLogic()
-    logic.run(self.inputSelector.currentNode(), self.inputLabelSelector.currentNode(), self.fname.text, self.progbar)
+    logic.run(self.inputSelector.currentNode(), self.inputLabelSelector.currentNode(), self.fname.text, self.progbar, int(self.maxmem.text) * 1024 * 1024, self.frameIndex.isChecked(), self.encoding.currentIndex, self.selectedLabels(), self.force.isChecked())
+
+  def onBatchButton(self):
+    logic = MVTBinaryExportLogic()
+    jobs = logic.scene_jobs(os.path.dirname(self.fname.text))
+    if len(jobs) == 0:
+      logging.info('No volumes with matching label maps to export')
+      return
+    try:
+      self.batchFutures = logic.start_batch(jobs, max_memory=int(self.maxmem.text) * 1024 * 1024,
+        frame_index=self.frameIndex.isChecked(), encoding=self.encoding.currentIndex, labels=self.selectedLabels(), force=self.force.isChecked())
+    except ValueError as e:
+      logging.error('Batch export not started: %s' % e)
+      return
+    self.batchButton.enabled = False
+    self.progbar.setValue(0)
+
+    # poll the workers from the UI thread rather than blocking on them
+    self.batchTimer = qt.QTimer()
+    self.batchTimer.setInterval(200)
+    self.batchTimer.connect('timeout()', self.onBatchTimer)
+    self.batchTimer.start()
+
+  def onBatchTimer(self):
+    done = [f for f in self.batchFutures if f.done()]
+    self.progbar.setValue(len(done) * 100 // len(self.batchFutures))
+    if len(done) < len(self.batchFutures):
+      return
+    self.batchTimer.stop()
+    self.batchButton.enabled = True
+    for f in done:
+      if f.exception() is not None:
+        logging.error('Batch export failed: %s' % f.exception())
+      else:
+        for result in f.result():
+          if result['skipped']:
+            logging.info('%s is unchanged' % result['file'])
+          else:
+            logging.info('Exported %s: %d bytes in %.1f s' % (result['file'], result['bytes'], result['seconds']))
 
 #
 # MVTBinaryExportLogic
@@ -171,72 +286,766 @@ class MVTBinaryExportLogic(ScriptedLoadableModuleLogic):
     
   def write_string(self, ofile, str):
     if(str is not None):
+      if not isinstance(str, bytes):
+        str = str.encode('utf-8')
       slen = len(str)
       ofile.write(pack('<h', slen))
-      for c in str:
-        ofile.write(c)
+      ofile.write(str)
     else:
       ofile.write(pack('<h', 0))
 
-  def run(self, input_vol, input_label_vol, fname, pb = None):
+  def frame_count(self, max_z, slices_per_frame):
+    return (max_z + slices_per_frame - 1) // slices_per_frame
+
+  def write_header(self, ofile, spacing, dims, strings, slices_per_frame = None, encoding = ENCODING_RAW):
+    """Write the file header.  dims is (x, y, z) of the exported voxels and
+    strings holds the values of HEADER_ATTRIBUTES in order.  If slices_per_frame
+    is given a version 2 header is written with an empty frame offset table,
+    and the position of the table is returned for write_frame_offsets.
     """
-    Run the actual algorithm
+    if slices_per_frame is not None:
+      ofile.write(MVT_MAGIC)
+      ofile.write(pack('<ii', MVT_VERSION, encoding))
+
+    ofile.write(pack('<ddd', spacing[0], spacing[1], spacing[2]))
+    ofile.write(pack('<iii', dims[0], dims[1], dims[2]))
+    for str in strings:
+      self.write_string(ofile, str)
+
+    if slices_per_frame is None:
+      return None
+
+    nframes = self.frame_count(dims[2], slices_per_frame)
+    ofile.write(pack('<ii', slices_per_frame, nframes))
+    table_pos = ofile.tell()
+    ofile.write(pack('<%dq' % nframes, *([0] * nframes)))
+    return table_pos
+
+  def write_frame_offsets(self, ofile, table_pos, offsets):
+    """Fill in the frame offset table of a version 2 header
     """
+    pos = ofile.tell()
+    ofile.seek(table_pos)
+    ofile.write(pack('<%dq' % len(offsets), *offsets))
+    ofile.seek(pos)
 
-    logging.info('Processing started')
-    if pb is None:
-      pass
-    else:
-      pb.setValue(0)
-      slicer.app.processEvents()
-      
-    a = slicer.util.array(input_vol.GetName())
-    lma = slicer.util.array(input_label_vol.GetName())
+  def mask_slab(self, a, lma, out = None, mask = None, label = 1):
+    """Return a slab of voxels as little-endian int16 with voxels outside
+    label set to -1001.  out and mask are optional scratch buffers of the
+    same shape as a which are reused if supplied.
+    """
+    if mask is None:
+      mask = np.empty(a.shape, dtype=bool)
+    np.equal(lma, label, out=mask)
+    return self.apply_mask(a, mask, out)
+
+  def apply_mask(self, a, mask, out = None):
+    """As mask_slab, given the boolean mask of the label
+    """
+    if out is None:
+      out = np.empty(a.shape, dtype='<i2')
+    out.fill(-1001)
+    np.copyto(out, a, casting='unsafe', where=mask)
+    return out
+
+  def write_slab(self, ofile, a, lma, out = None, mask = None, label = 1):
+    """Write a masked slab of voxels in a single call
+    """
+    ofile.write(self.mask_slab(a, lma, out, mask, label).data)
+
+  def compress_frame(self, a, mask, masked = None, level = DEFAULT_COMPRESSION_LEVEL):
+    """zlib compress one frame given the boolean mask of its label, and the
+    frame as masked by apply_mask if the caller already has it.  Called from
+    worker threads; both the NumPy masking and zlib release the GIL.
+    """
+    if masked is None:
+      masked = self.apply_mask(a, mask)
+    return zlib.compress(masked.data, level)
+
+  def sparse_frame(self, a, mask, masked = None):
+    """Encode one frame given the boolean mask of its label as run lengths of
+    the label along each row plus the values of the labelled voxels (see
+    ENCODING_SPARSE).  Only the labelled voxels are read, so the masked frame
+    is not needed.  The runs are found from the flat positions where the mask
+    changes, which are few, so the full frame is only passed over to find the
+    changes and gather the values.
+    """
+    width = a.shape[-1]
+    mask = mask.reshape(-1)
+    size = len(mask)
+
+    # a run which carries on from the end of one row must be split at the
+    #  start of the next
+    changes = np.flatnonzero(mask[1:] != mask[:-1]) + 1
+    rising = mask[changes]
+    row_starts = np.arange(width, size, width)
+    splits = row_starts[mask[row_starts] & mask[row_starts - 1]]
+    starts = np.concatenate(([0] if size and mask[0] else [], changes[rising], splits)).astype(np.intp)
+    ends = np.concatenate((changes[~rising], splits, [size] if size and mask[-1] else [])).astype(np.intp)
+    starts.sort()
+    ends.sort()
+
+    rows, columns = np.divmod(starts, width)
+    counts = np.bincount(rows, minlength=size // width).astype('<u2')
+    values = np.asarray(a).reshape(-1)[mask].astype('<i2')
+    return b''.join([pack('<qq', len(starts), len(values)), counts.tobytes(),
+      columns.astype('<u2').tobytes(), (ends - starts).astype('<u2').tobytes(), values.tobytes()])
+
+  def volume_array(self, volumeNode):
+    """Return a [z][y][x] view onto the scalars of a volume node without copying
+    """
+    import vtk.util.numpy_support
+    im = volumeNode.GetImageData()
+    shape = list(im.GetDimensions())
+    shape.reverse()
+    return vtk.util.numpy_support.vtk_to_numpy(im.GetPointData().GetScalars()).reshape(shape)
+
+  def slices_per_chunk(self, shape, max_memory = DEFAULT_MAX_MEMORY):
+    """Number of z slices of a [z][y][x] volume which can be streamed at once
+    whilst keeping the scratch buffers (int16 output plus boolean mask) below
+    max_memory bytes.  A max_memory of None streams the whole volume at once.
+    """
+    if max_memory is None:
+      return max(shape[0], 1)
+    slice_bytes = shape[1] * shape[2] * (np.dtype('<i2').itemsize + np.dtype(bool).itemsize)
+    return int(max(1, min(shape[0], max_memory // slice_bytes)))
+
+  def write_voxels(self, ofile, a, lma, z_start, z_end, max_memory = DEFAULT_MAX_MEMORY, pb = None):
+    """Stream slices z_start to z_end - 1 of a to ofile in fixed-size z-chunks.
+    The output and mask buffers are allocated once, so peak memory does not
+    depend on the number of slices exported.
+    """
+    self.write_voxels_labels({1: ofile}, a, lma, z_start, z_end, max_memory, pb)
+
+  def write_voxels_labels(self, ofiles, a, lma, z_start, z_end, max_memory = DEFAULT_MAX_MEMORY, pb = None):
+    """As write_voxels, but ofiles maps label values to output files.  Each
+    chunk is masked and written for every label before moving on to the next,
+    so the volume is only streamed once however many labels are exported.
+    """
+    chunk = self.slices_per_chunk(a.shape, max_memory)
+    out = np.empty((chunk,) + a.shape[1:], dtype='<i2')
+    mask = np.empty((chunk,) + a.shape[1:], dtype=bool)
+    labels = sorted(ofiles)
+
+    for z in range(z_start, z_end, chunk):
+      n = min(chunk, z_end - z)
+      # read each slab once, however many labels it is written for
+      a_slab = a[z:z + n]
+      lma_slab = lma[z:z + n]
+      for label in labels:
+        self.write_slab(ofiles[label], a_slab, lma_slab, out[:n], mask[:n], label)
+
+      if pb is None:
+        pass
+      else:
+        pb.setValue((z + n - z_start) * 100 // (z_end - z_start))
+        slicer.app.processEvents()
+
+  def write_frames(self, ofiles, a, lma, z_start, z_end, slices_per_frame, encode_frame, threads = None, pb = None, digests = None):
+    """Encode each frame of slices z_start to z_end - 1 with
+    encode_frame(a, mask, masked) on a thread pool and write the blocks in
+    order, where mask is the boolean mask of the label and masked is the
+    frame as masked by apply_mask, or None if it is not needed for a digest.
+    ofiles maps label values to output files and every frame is encoded for
+    each label while it is in hand.  At most two blocks per thread are held in
+    memory at once.  If digests maps labels to _DigestWriter objects, the
+    masked voxels of each frame are hashed into them as its block is written.
+    Returns the file offset of each block, by label.
+    """
+    if threads is None:
+      threads = os.cpu_count() or 1
+    labels = sorted(ofiles)
+    nblocks = self.frame_count(z_end - z_start, slices_per_frame) * len(labels)
+    offsets = dict((label, []) for label in labels)
+    pending = collections.deque()
+
+    def encode(a, lma, label):
+      mask = np.equal(lma, label)
+      # masked once for both the encoder and the digest
+      masked = None if digests is None else self.apply_mask(a, mask)
+      return encode_frame(a, mask, masked), masked
+
+    def write_block(label, encoded):
+      block, masked = encoded
+      if masked is not None:
+        digests[label].write(masked.data)
+      offsets[label].append(ofiles[label].tell())
+      ofiles[label].write(block)
+      if pb is None:
+        pass
+      else:
+        pb.setValue(sum(len(o) for o in offsets.values()) * 100 // nblocks)
+        slicer.app.processEvents()
+
+    pool = ThreadPoolExecutor(max_workers=threads)
+    try:
+      for z in range(z_start, z_end, slices_per_frame):
+        z_frame_end = min(z + slices_per_frame, z_end)
+        a_frame = a[z:z_frame_end]
+        lma_frame = lma[z:z_frame_end]
+        for label in labels:
+          pending.append((label, pool.submit(encode, a_frame, lma_frame, label)))
+          if len(pending) >= 2 * threads:
+            label_done, future = pending.popleft()
+            write_block(label_done, future.result())
+      while pending:
+        label_done, future = pending.popleft()
+        write_block(label_done, future.result())
+    finally:
+      pool.shutdown()
+
+    return offsets
+
+  def export_array(self, fname, a, lma, spacing, strings, max_memory = DEFAULT_MAX_MEMORY, pb = None, slices_per_frame = None, padded = True, encoding = ENCODING_RAW, threads = None):
+    """Export a [z][y][x] array and its label map to fname.  If padded, the
+    blank padding added by MVTConvert is not written (see export_range).
+    Passing slices_per_frame writes a version 2 header with a
+    frame offset table.  ENCODING_ZLIB and ENCODING_SPARSE encode each frame
+    on a pool of threads and always write a version 2 header, with one slice
+    per frame if slices_per_frame is not given.
+    """
+    self.export_labels({1: fname}, a, lma, spacing, strings, max_memory, pb, slices_per_frame, padded, encoding, threads)
+
+  def export_labels(self, fnames, a, lma, spacing, strings, max_memory = DEFAULT_MAX_MEMORY, pb = None, slices_per_frame = None, padded = True, encoding = ENCODING_RAW, threads = None, digests = None):
+    """As export_array, but fnames maps label values to file names.  Each file
+    holds the voxels of its own label and they are all written in a single pass
+    over a.  If a dict is passed as digests, it is filled with the
+    content_digests of each label, hashed as the voxels are written.
+    """
     max_z = len(a)
     max_y = len(a[0])
     max_x = len(a[0][0])
-    
-    imageSpacing=input_vol.GetSpacing()
-    
-    source_name = input_vol.GetAttribute('pig_dyn.SourceName')
-    acquisition_datetime = input_vol.GetAttribute('pig_dyn.AcquisitionDateTime')
-    series_name = input_vol.GetAttribute('pig_dyn.SeriesName')
-    patient_name = input_vol.GetAttribute('pig_dyn.PatientName')
-    
-    ofile = open(fname, 'wb')
-    ofile.write(pack('<ddd', imageSpacing[0], imageSpacing[1], imageSpacing[2]))
-    ofile.write(pack('<iii', max_x, max_y, max_z - 2))
-    
-    self.write_string(ofile, source_name)
-    self.write_string(ofile, acquisition_datetime)
-    self.write_string(ofile, series_name)
-    self.write_string(ofile, patient_name)
-    
-    for z in xrange(0, max_z):
-      if(z == 0):
-        pass
-      elif(z == (max_z - 1)):
-        pass
+
+    z_start, z_end = self.export_range(max_z, padded, slices_per_frame)
+    dims = (max_x, max_y, z_end - z_start)
+
+    if encoding == ENCODING_RAW:
+      encode_frame = None
+    elif encoding == ENCODING_ZLIB:
+      encode_frame = functools.partial(self.compress_frame, level=DEFAULT_COMPRESSION_LEVEL)
+    elif encoding == ENCODING_SPARSE:
+      encode_frame = self.sparse_frame
+    else:
+      raise ValueError('unknown MVT binary encoding %d' % encoding)
+    if encode_frame is not None and slices_per_frame is None:
+      slices_per_frame = 1
+
+    labels = sorted(fnames)
+    ofiles = dict((label, open(fnames[label], 'wb')) for label in labels)
+    writers = None
+    try:
+      table_pos = {}
+      for label in labels:
+        table_pos[label] = self.write_header(ofiles[label], spacing, dims, strings, slices_per_frame, encoding)
+
+      if encode_frame is None:
+        if slices_per_frame is not None:
+          frame_bytes = slices_per_frame * max_y * max_x * np.dtype('<i2').itemsize
+          nframes = self.frame_count(dims[2], slices_per_frame)
+          for label in labels:
+            data_offset = ofiles[label].tell()
+            self.write_frame_offsets(ofiles[label], table_pos[label], [data_offset + f * frame_bytes for f in range(0, nframes)])
+        if digests is None:
+          self.write_voxels_labels(ofiles, a, lma, z_start, z_end, max_memory, pb)
+        else:
+          # hash each chunk as it is written
+          writers = dict((label, _DigestWriter(ofiles[label])) for label in labels)
+          self.write_voxels_labels(writers, a, lma, z_start, z_end, max_memory, pb)
       else:
-        for y in xrange(0, max_y):
-          for x in xrange(0, max_x):
-            if(lma[z][y][x] == 1):
-              ofile.write(pack('<h', a[z][y][x]))
-            else:
-              ofile.write(pack('<h', -1001))
-      
+        if digests is not None:
+          writers = dict((label, _DigestWriter()) for label in labels)
+        offsets = self.write_frames(ofiles, a, lma, z_start, z_end, slices_per_frame, encode_frame, threads, pb, writers)
+        for label in labels:
+          self.write_frame_offsets(ofiles[label], table_pos[label], offsets[label])
+    finally:
+      for ofile in ofiles.values():
+        ofile.close()
+    if writers is not None:
+      digests.update((label, writers[label].digest.hexdigest()) for label in labels)
+
+  def export_range(self, max_z, padded, slices_per_frame = None):
+    """Slices which are exported, as (first, one past the last).  MVTConvert
+    pads with one blank slice before the data and the rest of a frame plus one
+    more frame after it, so when the padded slices make up whole frames only
+    the data frames are exported and the frame offset table holds no padding.
+    """
+    if not padded:
+      return 0, max_z
+    if slices_per_frame is not None and slices_per_frame > 1 and \
+       max_z % slices_per_frame == 0 and max_z >= 3 * slices_per_frame:
+      nframes = max_z // slices_per_frame - 2
+      return 1, 1 + nframes * slices_per_frame
+    return 1, max_z - 1
+
+  def manifest_filename(self, fname):
+    return fname + '.manifest'
+
+  def manifest_header(self, job, label):
+    """Everything other than the voxel values which determines the contents of
+    an exported file, in the form it is stored in a manifest
+    """
+    header = {
+      'spacing': job['spacing'],
+      'shape': job['a'].shape,
+      'strings': job['strings'],
+      'slices_per_frame': job['slices_per_frame'],
+      'padded': job['padded'],
+      'encoding': job['encoding'],
+      'label': label,
+      }
+    return json.loads(json.dumps(header))
+
+  def read_manifest(self, fname):
+    try:
+      mfile = open(self.manifest_filename(fname), 'r')
+    except IOError:
+      return None
+    try:
+      return json.load(mfile)
+    except ValueError:
+      return None
+    finally:
+      mfile.close()
+
+  def write_manifest(self, fname, job, label, digest):
+    manifest = {
+      'header': self.manifest_header(job, label),
+      'digest': digest,
+      'mtimes': job['mtimes'],
+      'size': os.path.getsize(fname),
+      }
+    mfile = open(self.manifest_filename(fname), 'w')
+    json.dump(manifest, mfile, indent=1)
+    mfile.close()
+
+  def content_digests(self, job, labels, max_memory = DEFAULT_MAX_MEMORY):
+    """SHA-1 of the masked voxels that would be exported for each label,
+    computed in one streamed pass over the volume
+    """
+    if len(labels) == 0:
+      return {}
+    writers = dict((label, _DigestWriter()) for label in labels)
+    z_start, z_end = self.export_range(len(job['a']), job['padded'], job['slices_per_frame'])
+    self.write_voxels_labels(writers, job['a'], job['lma'], z_start, z_end, max_memory)
+    return dict((label, writers[label].digest.hexdigest()) for label in labels)
+
+  def export_cached(self, job, max_memory = DEFAULT_MAX_MEMORY, pb = None, threads = None, force = False):
+    """Export a job from export_job, skipping any file whose sidecar manifest
+    shows it is already up to date.  A file is up to date if it has the size
+    and header recorded in its manifest and either the node modification times
+    are unchanged since this process wrote it or the masked voxels hash to the
+    recorded digest.  Returns the labels which were skipped.
+    """
+    fnames = job['fnames']
+    manifests = {}
+    if not force:
+      for label in fnames:
+        manifest = self.read_manifest(fnames[label])
+        if manifest is not None and os.path.exists(fnames[label]) and \
+          manifest['size'] == os.path.getsize(fnames[label]) and \
+          manifest['header'] == self.manifest_header(job, label):
+          manifests[label] = manifest
+
+    skipped = [label for label in manifests if manifests[label]['mtimes'] == job['mtimes']]
+    # only hash ahead of writing when there is a manifest to compare against
+    digests = self.content_digests(job, [label for label in manifests if label not in skipped], max_memory)
+    for label in digests:
+      if manifests[label]['digest'] == digests[label]:
+        skipped.append(label)
+        # record the current modification times so the next check is cheap
+        self.write_manifest(fnames[label], job, label, digests[label])
+
+    to_write = dict((label, fnames[label]) for label in fnames if label not in skipped)
+    if len(to_write) > 0:
+      digests = {}
+      self.export_labels(to_write, job['a'], job['lma'], job['spacing'], job['strings'], max_memory,
+        pb, job['slices_per_frame'], job['padded'], job['encoding'], threads, digests)
+      for label in to_write:
+        self.write_manifest(fnames[label], job, label, digests[label])
+    for label in skipped:
+      logging.info('%s is unchanged, not exporting' % fnames[label])
+    return sorted(skipped)
+
+  def default_filename(self, input_vol, directory):
+    """Export file name for a converted volume, based on its acquisition time
+    """
+    stamp = input_vol.GetAttribute('pig_dyn.AcquisitionDateTime')
+    if stamp is None:
+      stamp = input_vol.GetName()
+    return os.path.join(directory, 'analysis-' + stamp + '.bin')
+
+  def label_filename(self, fname, label):
+    """File name for one label of a multi-label export, e.g. analysis-2.bin
+    """
+    base, ext = os.path.splitext(fname)
+    return '%s-%d%s' % (base, label, ext)
+
+  def build_job(self, fname, a, lma, spacing, attributes, slices_per_frame, padded, frame_index, encoding, labels, mtimes):
+    """Bundle the arguments of export_labels into a job for export_cached
+    """
+    if not frame_index and encoding == ENCODING_RAW:
+      slices_per_frame = None
+    if labels is None:
+      fnames = {1: fname}
+    else:
+      fnames = dict((label, self.label_filename(fname, label)) for label in labels)
+    return {
+      'fnames': fnames,
+      'a': a,
+      'lma': lma,
+      'spacing': spacing,
+      'strings': [attributes.get(attr) for attr in HEADER_ATTRIBUTES],
+      'slices_per_frame': slices_per_frame,
+      'padded': padded,
+      'encoding': encoding,
+      # modification times are only comparable within one process
+      'mtimes': mtimes + [SESSION_TOKEN],
+      }
+
+  def export_job(self, input_vol, input_label_vol, fname, frame_index = False, encoding = ENCODING_RAW, labels = None):
+    """Gather everything export_labels needs from the volume nodes.  This must
+    be called on the main thread; the export itself only touches the returned
+    arrays and can run anywhere.
+    """
+    slices_per_frame, padded = MVTConvertLogic().frameLayout(input_vol)
+    attributes = dict((attr, input_vol.GetAttribute(attr)) for attr in HEADER_ATTRIBUTES)
+    mtimes = [input_vol.GetMTime(), input_vol.GetImageData().GetMTime(),
+      input_label_vol.GetMTime(), input_label_vol.GetImageData().GetMTime()]
+    return self.build_job(fname, self.volume_array(input_vol), self.volume_array(input_label_vol), input_vol.GetSpacing(),
+      attributes, slices_per_frame, padded, frame_index, encoding, labels, mtimes)
+
+  def multivolume_job(self, input_mv, input_label_vol, fname, sframe, nframes, finterval, zslices, frame_index = False, encoding = ENCODING_RAW, labels = None):
+    """As export_job, but for frames selected from a MultiVolume as MVTConvert
+    would select them.  The concatenated volume is never built; its slices are
+    gathered from the MultiVolume a chunk at a time as they are exported.  The
+    label map must have the geometry of the converted volume, with or without
+    the padding slices.
+    """
+    convert = MVTConvertLogic()
+    a4 = convert.multiVolumeArray(input_mv)
+    if nframes == -1:
+      nframes = a4.shape[0] * a4.shape[3]
+    lma = self.volume_array(input_label_vol)
+    padded = len(lma) != nframes * zslices
+    a = ConcatenatedFrames(a4, sframe, nframes, finterval, zslices, padded)
+    if lma.shape != a.shape:
+      raise ValueError('label map %s does not match %d frames of %d slices from %s' % (input_label_vol.GetName(), nframes, zslices, input_mv.GetName()))
+
+    mtimes = [input_mv.GetMTime(), input_mv.GetImageData().GetMTime(),
+      input_label_vol.GetMTime(), input_label_vol.GetImageData().GetMTime()]
+    return self.build_job(fname, a, lma, input_mv.GetSpacing(), convert.frameAttributes(input_mv),
+      zslices, padded, frame_index, encoding, labels, mtimes)
+
+  def export_timed(self, job, max_memory = DEFAULT_MAX_MEMORY, threads = 1, force = False):
+    """Run a job from export_job through export_cached and return one result
+    per output file, in label order, giving the file name, whether it was
+    skipped as unchanged, the bytes written to it and the time taken to write
+    it.  The labels of a job are written in a single pass, so the files it
+    writes share that pass's time.
+    """
+    start = time.time()
+    skipped = self.export_cached(job, max_memory, None, threads, force)
+    seconds = time.time() - start
+    results = []
+    for label in sorted(job['fnames']):
+      fname = job['fnames'][label]
+      results.append({
+        'file': fname,
+        'skipped': label in skipped,
+        'seconds': 0.0 if label in skipped else seconds,
+        'bytes': 0 if label in skipped else os.path.getsize(fname),
+        })
+    return results
+
+  def scene_jobs(self, directory):
+    """(volume, label map, file name) for every scalar volume in the scene that
+    has a label map named as MVTConvert names them (<volume>-label)
+    """
+    jobs = []
+    fnames = set()
+    for input_vol in slicer.util.getNodesByClass('vtkMRMLScalarVolumeNode'):
+      if input_vol.IsA('vtkMRMLLabelMapVolumeNode'):
+        continue
+      label_vols = slicer.mrmlScene.GetNodesByClassByName('vtkMRMLLabelMapVolumeNode', input_vol.GetName() + '-label')
+      if label_vols.GetNumberOfItems() > 0:
+        fname = self.default_filename(input_vol, directory)
+        if fname in fnames:
+          # e.g. two conversions of one MultiVolume share an acquisition time
+          base, ext = os.path.splitext(fname)
+          fname = base + '-' + input_vol.GetID() + ext
+        fnames.add(fname)
+        jobs.append((input_vol, label_vols.GetItemAsObject(0), fname))
+    return jobs
+
+  def check_batch_files(self, gathered):
+    """Raise ValueError if two jobs from export_job would write the same file
+    """
+    seen = set()
+    for job in gathered:
+      for fname in job['fnames'].values():
+        path = os.path.normcase(os.path.abspath(fname))
+        if path in seen:
+          raise ValueError('more than one batch job writes %s' % fname)
+        seen.add(path)
+
+  def start_batch(self, jobs, max_workers = None, max_memory = DEFAULT_MAX_MEMORY, frame_index = False, encoding = ENCODING_RAW, labels = None, force = False):
+    """Start exporting a list of (volume, label map, file name) tuples on a
+    bounded thread pool and return immediately with one future per job.  Each
+    future's result is as per export_timed.  Node data is gathered here, on
+    the calling thread, so the workers never touch the MRML scene.  Raises
+    ValueError, before anything is written, if two jobs share an output file.
+    """
+    if max_workers is None:
+      max_workers = min(len(jobs), os.cpu_count() or 1)
+    gathered = [self.export_job(input_vol, input_label_vol, fname, frame_index, encoding, labels)
+      for input_vol, input_label_vol, fname in jobs]
+    self.check_batch_files(gathered)
+
+    pool = ThreadPoolExecutor(max_workers=max(1, max_workers))
+    futures = [pool.submit(self.export_timed, job, max_memory, 1, force) for job in gathered]
+    # worker threads exit once the queue is drained
+    pool.shutdown(wait=False)
+    return futures
+
+  def run_batch(self, jobs, max_workers = None, max_memory = DEFAULT_MAX_MEMORY, frame_index = False, encoding = ENCODING_RAW, labels = None, pb = None, force = False):
+    """Export a list of (volume, label map, file name) tuples concurrently and
+    wait for them, processing events while they run so the application stays
+    responsive.  Returns the per-file results of export_timed in job order.
+    """
+    futures = self.start_batch(jobs, max_workers, max_memory, frame_index, encoding, labels, force)
+    pending = futures
+    while pending:
+      done, pending = wait(pending, timeout=0.1)
       if pb is None:
         pass
       else:
-        pb.setValue(z * 100 / (max_z - 1))
-        slicer.app.processEvents()
+        pb.setValue((len(futures) - len(pending)) * 100 // len(futures))
+      slicer.app.processEvents()
+    return [result for f in futures for result in f.result()]
+
+  def run(self, input_vol, input_label_vol, fname, pb = None, max_memory = DEFAULT_MAX_MEMORY, frame_index = False, encoding = ENCODING_RAW, labels = None, force = False):
+    """
+    Run the actual algorithm.  If a list of labels is given, one file per label
+    is written in a single pass, named as per label_filename.  Files which are
+    already up to date are not rewritten unless force is set.
+    """
+
+    logging.info('Processing started')
+    if pb is None:
+      pass
+    else:
+      pb.setValue(0)
+      slicer.app.processEvents()
+      
+    job = self.export_job(input_vol, input_label_vol, fname, frame_index, encoding, labels)
+    self.export_cached(job, max_memory, pb, force=force)
+
+    logging.info('Processing completed')
+
+    return True
+
+
+  def run_multivolume(self, input_mv, input_label_vol, fname, sframe, nframes, finterval, zslices, pb = None, max_memory = DEFAULT_MAX_MEMORY, frame_index = False, encoding = ENCODING_RAW, labels = None, force = False):
+    """
+    Export frames of a MultiVolume straight to the binary format, giving the
+    same file as MVTConvertLogic.run followed by run but without creating the
+    intermediate volume
+    """
+
+    logging.info('Processing started')
+    if pb is None:
+      pass
+    else:
+      pb.setValue(0)
+      slicer.app.processEvents()
+
+    job = self.multivolume_job(input_mv, input_label_vol, fname, sframe, nframes, finterval, zslices, frame_index, encoding, labels)
+    self.export_cached(job, max_memory, pb, force=force)
 
-    ofile.close()
     logging.info('Processing completed')
 
     return True
 
 
+class _DigestWriter(object):
+  """File-like object which hashes whatever is written to it and, if given a
+  file, passes it on
+  """
+
+  def __init__(self, ofile = None):
+    self.digest = hashlib.sha1()
+    self.ofile = ofile
+
+  def write(self, data):
+    self.digest.update(data)
+    if self.ofile is not None:
+      self.ofile.write(data)
+
+
+#
+# MVTBinaryReader
+#
+
+class MVTBinaryReader(object):
+  """Reads a file written by MVTBinaryExportLogic.  The header is parsed on
+  construction and the voxels are exposed as a [z][y][x] np.memmap, so
+  nothing is read from disk until it is accessed.  Both version 1 files and
+  version 2 files with a frame offset table are supported.  Frames of zlib
+  compressed and sparse files are decoded individually on request.
+  """
+
+  def __init__(self, fname):
+    self.fname = fname
+    ifile = open(fname, 'rb')
+    if ifile.read(len(MVT_MAGIC)) == MVT_MAGIC:
+      self.version, self.encoding = self.read_struct(ifile, '<ii')
+      if self.version != MVT_VERSION:
+        ifile.close()
+        raise ValueError('%s: unsupported MVT binary version %d' % (fname, self.version))
+      if self.encoding not in (ENCODING_RAW, ENCODING_ZLIB, ENCODING_SPARSE):
+        ifile.close()
+        raise ValueError('%s: unsupported MVT binary encoding %d' % (fname, self.encoding))
+    else:
+      ifile.seek(0)
+      self.version = 1
+      self.encoding = ENCODING_RAW
+
+    self.spacing = self.read_struct(ifile, '<ddd')
+    self.dims = self.read_struct(ifile, '<iii')
+    self.strings = [self.read_string(ifile) for attr in HEADER_ATTRIBUTES]
+
+    if self.version == 1:
+      self.slices_per_frame = None
+      self.frame_offsets = None
+    else:
+      self.slices_per_frame, nframes = self.read_struct(ifile, '<ii')
+      self.frame_offsets = self.read_struct(ifile, '<%dq' % nframes)
+    self.data_offset = ifile.tell()
+    ifile.seek(0, os.SEEK_END)
+    self.file_size = ifile.tell()
+    ifile.close()
+
+    self.shape = (self.dims[2], self.dims[1], self.dims[0])
+    self._data = None
+
+  def read_struct(self, ifile, fmt):
+    return unpack(fmt, ifile.read(calcsize(fmt)))
+
+  def read_string(self, ifile):
+    slen = self.read_struct(ifile, '<h')[0]
+    if slen == 0:
+      return None
+    return ifile.read(slen).decode('utf-8')
+
+  def attributes(self):
+    """Header strings as a dictionary of volume attributes
+    """
+    return dict((attr, str) for attr, str in zip(HEADER_ATTRIBUTES, self.strings) if str is not None)
+
+  @property
+  def data(self):
+    """The voxels as a copy-on-write memory map shaped [z][y][x].  Pages are
+    only copied if the array is written to; the file itself is never modified.
+    Compressed and sparse files are decoded into memory instead.
+    """
+    if self._data is None:
+      if self.encoding != ENCODING_RAW:
+        self._data = np.empty(self.shape, dtype='<i2')
+        for f in range(0, self.nframes):
+          z = f * self.slices_per_frame
+          self._data[z:z + self.frame_slices(f)] = self.frame(f)
+      else:
+        self._data = np.memmap(self.fname, dtype='<i2', mode='c', offset=self.data_offset, shape=self.shape)
+    return self._data
+
+  @property
+  def nframes(self):
+    if self.frame_offsets is None:
+      return None
+    return len(self.frame_offsets)
+
+  def frame_slices(self, n):
+    """Number of z slices in frame n; the last frame may be short
+    """
+    return min(self.slices_per_frame, self.dims[2] - n * self.slices_per_frame)
+
+  def frame(self, n):
+    """Frame n as a [z][y][x] array, located through the frame offset table
+    """
+    if self.frame_offsets is None:
+      raise ValueError('%s: version 1 files have no frame offset table' % self.fname)
+    shape = (self.frame_slices(n), self.dims[1], self.dims[0])
+    if self.encoding == ENCODING_ZLIB:
+      return np.frombuffer(zlib.decompress(self.read_block(n)), dtype='<i2').reshape(shape)
+    if self.encoding == ENCODING_SPARSE:
+      return self.decode_sparse(self.read_block(n), shape)
+    return np.memmap(self.fname, dtype='<i2', mode='c', offset=self.frame_offsets[n], shape=shape)
+
+  def decode_sparse(self, block, shape):
+    """Rebuild a dense frame from an ENCODING_SPARSE block
+    """
+    nruns, nvalues = unpack_from('<qq', block)
+    width = shape[-1]
+    nrows = int(np.prod(shape[:-1]))
+    pos = calcsize('<qq')
+    counts = np.frombuffer(block, dtype='<u2', count=nrows, offset=pos)
+    pos += counts.nbytes
+    starts = np.frombuffer(block, dtype='<u2', count=nruns, offset=pos)
+    pos += starts.nbytes
+    lengths = np.frombuffer(block, dtype='<u2', count=nruns, offset=pos)
+    pos += lengths.nbytes
+    values = np.frombuffer(block, dtype='<i2', count=nvalues, offset=pos)
+
+    # flat positions of the start and one past the end of every run, then a
+    #  running sum gives the mask
+    run_starts = np.repeat(np.arange(nrows, dtype=np.int64), counts) * width + starts
+    run_ends = run_starts + lengths
+    size = nrows * width
+    edges = np.bincount(run_starts, minlength=size + 1) - np.bincount(run_ends, minlength=size + 1)
+    mask = np.cumsum(edges[:size]) > 0
+
+    out = np.full(size, -1001, dtype='<i2')
+    out[mask] = values
+    return out.reshape(shape)
+
+  def read_block(self, n):
+    """Raw bytes of frame n as stored in the file
+    """
+    if n + 1 < self.nframes:
+      end = self.frame_offsets[n + 1]
+    else:
+      end = self.file_size
+    ifile = open(self.fname, 'rb')
+    ifile.seek(self.frame_offsets[n])
+    block = ifile.read(end - self.frame_offsets[n])
+    ifile.close()
+    return block
+
+  def toVolumeNode(self, name = None):
+    """Create a scalar volume node whose image data references the memory map
+    directly rather than a copy of it.
+    """
+    import vtk.util.numpy_support
+    data = self.data
+    scalars = vtk.util.numpy_support.numpy_to_vtk(data.reshape(-1), deep=False, array_type=vtk.VTK_SHORT)
+    # keep the memory map alive for as long as VTK references its buffer
+    scalars._numpy_reference = data
+
+    imageData = vtk.vtkImageData()
+    imageData.SetDimensions(self.dims)
+    imageData.GetPointData().SetScalars(scalars)
+
+    if name is None:
+      name = os.path.splitext(os.path.basename(self.fname))[0]
+    volumeNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLScalarVolumeNode', name)
+    volumeNode.SetSpacing(self.spacing)
+    volumeNode.SetAndObserveImageData(imageData)
+    volumeNode.CreateDefaultDisplayNodes()
+    for attr, str in self.attributes().items():
+      volumeNode.SetAttribute(attr, str)
+    return volumeNode
+
+
 class MVTBinaryExportTest(ScriptedLoadableModuleTest):
   """
   This is the test case for your scripted module.
@@ -254,6 +1063,18 @@ class MVTBinaryExportTest(ScriptedLoadableModuleTest):
     """
     self.setUp()
     self.test_MVTBinaryExport1()
+    self.test_MVTBinaryExportSlab()
+    self.test_MVTBinaryExportChunked()
+    self.test_MVTBinaryReader()
+    self.test_MVTBinaryReaderFrames()
+    self.test_MVTBinaryReaderPaddedFrames()
+    self.test_MVTBinaryReaderCompressed()
+    self.test_MVTBinaryReaderSparse()
+    self.test_MVTBinaryExportLabels()
+    self.test_MVTBinaryExportCache()
+    self.test_MVTBinaryExportDigests()
+    self.test_MVTBinaryExportBatchFiles()
+    self.test_MVTBinaryExportMultiVolume()
 
   def test_MVTBinaryExport1(self):
     """ Ideally you should have several levels of tests.  At the lowest level
@@ -290,3 +1111,344 @@ class MVTBinaryExportTest(ScriptedLoadableModuleTest):
     logic = MVTBinaryExportLogic()
     self.assertTrue( logic.hasImageData(volumeNode) )
     self.delayDisplay('Test passed!')
+
+  def test_MVTBinaryExportSlab(self):
+    """ Check the vectorised slab writer produces the same bytes as the
+    original per-voxel loop.
+    """
+
+    import io
+    self.delayDisplay("Starting the slab writer test")
+
+    rs = np.random.RandomState(0)
+    a = rs.randint(-1500, 1500, size=(5, 7, 9)).astype(np.int16)
+    lma = rs.randint(0, 3, size=(5, 7, 9)).astype(np.int16)
+
+    expected = io.BytesIO()
+    for z in range(0, len(a)):
+      for y in range(0, len(a[0])):
+        for x in range(0, len(a[0][0])):
+          if(lma[z][y][x] == 1):
+            expected.write(pack('<h', a[z][y][x]))
+          else:
+            expected.write(pack('<h', -1001))
+
+    actual = io.BytesIO()
+    logic = MVTBinaryExportLogic()
+    for z in range(0, len(a)):
+      logic.write_slab(actual, a[z], lma[z])
+
+    self.assertEqual(expected.getvalue(), actual.getvalue())
+    self.delayDisplay('Test passed!')
+
+  def test_MVTBinaryExportChunked(self):
+    """ Check the chunk size does not change the streamed output.
+    """
+
+    import io
+    self.delayDisplay("Starting the chunked writer test")
+
+    rs = np.random.RandomState(1)
+    a = rs.randint(-1500, 1500, size=(11, 6, 5)).astype(np.int16)
+    lma = rs.randint(0, 2, size=(11, 6, 5)).astype(np.uint8)
+
+    logic = MVTBinaryExportLogic()
+    whole = io.BytesIO()
+    logic.write_voxels(whole, a, lma, 1, 10, None)
+    for max_memory in (1, 6 * 5 * 3 * 4, 10 ** 6):
+      chunked = io.BytesIO()
+      logic.write_voxels(chunked, a, lma, 1, 10, max_memory)
+      self.assertEqual(whole.getvalue(), chunked.getvalue())
+
+    self.assertEqual(len(whole.getvalue()), 9 * 6 * 5 * 2)
+    self.delayDisplay('Test passed!')
+
+  def test_MVTBinaryReader(self):
+    """ Round-trip a synthetic volume through the writer and reader.
+    """
+
+    self.delayDisplay("Starting the reader test")
+
+    rs = np.random.RandomState(2)
+    a = rs.randint(-1500, 1500, size=(8, 6, 5)).astype(np.int16)
+    lma = rs.randint(0, 2, size=(8, 6, 5)).astype(np.uint8)
+    strings = ['source', '20200101120000.000000', None, 'Pig^One']
+
+    fname = slicer.app.temporaryPath + '/MVTBinaryReaderTest.bin'
+    logic = MVTBinaryExportLogic()
+    logic.export_array(fname, a, lma, (0.5, 0.75, 2.0), strings)
+
+    reader = MVTBinaryReader(fname)
+    self.assertEqual(reader.spacing, (0.5, 0.75, 2.0))
+    self.assertEqual(reader.dims, (5, 6, 6))
+    self.assertEqual(reader.strings, strings)
+    self.assertEqual(reader.data.shape, (6, 6, 5))
+    self.assertTrue(np.array_equal(reader.data, np.where(lma == 1, a, -1001)[1:-1]))
+    self.assertEqual(reader.data_offset + reader.data.nbytes, os.path.getsize(fname))
+
+    volumeNode = reader.toVolumeNode()
+    self.assertTrue(np.array_equal(slicer.util.arrayFromVolume(volumeNode), reader.data))
+    self.assertEqual(volumeNode.GetAttribute('pig_dyn.PatientName'), 'Pig^One')
+    self.delayDisplay('Test passed!')
+
+  def test_MVTBinaryReaderFrames(self):
+    """ Check frames can be read back through a version 2 frame offset table,
+    and that the same voxels written without one are read as version 1.
+    """
+
+    self.delayDisplay("Starting the frame index test")
+
+    rs = np.random.RandomState(3)
+    a = rs.randint(-1500, 1500, size=(14, 4, 3)).astype(np.int16)
+    lma = rs.randint(0, 2, size=(14, 4, 3)).astype(np.uint8)
+    expected = np.where(lma == 1, a, -1001)[1:-1]
+    strings = ['source', None, '3', None]
+
+    logic = MVTBinaryExportLogic()
+    fname_v1 = slicer.app.temporaryPath + '/MVTBinaryReaderTest-v1.bin'
+    fname_v2 = slicer.app.temporaryPath + '/MVTBinaryReaderTest-v2.bin'
+    logic.export_array(fname_v1, a, lma, (1.0, 1.0, 1.0), strings)
+    logic.export_array(fname_v2, a, lma, (1.0, 1.0, 1.0), strings, slices_per_frame=5)
+
+    reader_v1 = MVTBinaryReader(fname_v1)
+    self.assertEqual(reader_v1.version, 1)
+    self.assertEqual(reader_v1.nframes, None)
+    self.assertRaises(ValueError, reader_v1.frame, 0)
+
+    reader_v2 = MVTBinaryReader(fname_v2)
+    self.assertEqual(reader_v2.version, 2)
+    self.assertEqual(reader_v2.strings, strings)
+    self.assertEqual(reader_v2.slices_per_frame, 5)
+    self.assertEqual(reader_v2.nframes, 3)
+    self.assertTrue(np.array_equal(reader_v2.data, reader_v1.data))
+    for f in range(0, 3):
+      self.assertTrue(np.array_equal(reader_v2.frame(f), expected[f * 5:(f + 1) * 5]))
+    self.assertEqual(reader_v2.frame(2).shape, (2, 4, 3))
+    self.delayDisplay('Test passed!')
+
+  def test_MVTBinaryReaderPaddedFrames(self):
+    """ Check the padding MVTConvert adds around multi-slice frames is left
+    out of the frame offset table.
+    """
+
+    self.delayDisplay("Starting the padded frames test")
+
+    zslices = 3
+    nframes = 3
+    rs = np.random.RandomState(7)
+    a = rs.randint(-1500, 1500, size=(zslices * (nframes + 2), 4, 3)).astype(np.int16)
+    lma = np.ones(a.shape, dtype=np.uint8)
+    expected = a[1:1 + nframes * zslices]
+    strings = ['source', None, '3', None]
+
+    logic = MVTBinaryExportLogic()
+    for encoding in (ENCODING_RAW, ENCODING_ZLIB):
+      fname = slicer.app.temporaryPath + '/MVTBinaryReaderTest-padded-%d.bin' % encoding
+      logic.export_array(fname, a, lma, (1.0, 1.0, 1.0), strings, slices_per_frame=zslices, encoding=encoding)
+      reader = MVTBinaryReader(fname)
+      self.assertEqual(reader.nframes, nframes)
+      self.assertEqual(reader.dims[2], nframes * zslices)
+      for f in range(0, nframes):
+        self.assertTrue(np.array_equal(reader.frame(f), expected[f * zslices:(f + 1) * zslices]))
+    self.delayDisplay('Test passed!')
+
+  def test_MVTBinaryReaderCompressed(self):
+    """ Check a zlib compressed export reads back frame by frame.
+    """
+
+    self.delayDisplay("Starting the compressed export test")
+
+    rs = np.random.RandomState(4)
+    a = rs.randint(-1500, 1500, size=(12, 8, 7)).astype(np.int16)
+    lma = np.zeros((12, 8, 7), dtype=np.uint8)
+    lma[:, 2:6, 3:5] = 1
+    # 2 frames of 3 slices, padded as by MVTConvert
+    expected = np.where(lma == 1, a, -1001)[1:7]
+
+    logic = MVTBinaryExportLogic()
+    fname = slicer.app.temporaryPath + '/MVTBinaryReaderTest-zlib.bin'
+    logic.export_array(fname, a, lma, (1.0, 1.0, 1.0), [None] * 4, slices_per_frame=3, encoding=ENCODING_ZLIB, threads=2)
+
+    reader = MVTBinaryReader(fname)
+    self.assertEqual(reader.encoding, ENCODING_ZLIB)
+    self.assertEqual(reader.nframes, 2)
+    self.assertTrue(np.array_equal(reader.frame(0), expected[0:3]))
+    self.assertTrue(np.array_equal(reader.frame(1), expected[3:6]))
+    self.assertTrue(np.array_equal(reader.data, expected))
+    self.assertTrue(os.path.getsize(fname) < expected.nbytes)
+    self.delayDisplay('Test passed!')
+
+  def test_MVTBinaryReaderSparse(self):
+    """ Check a sparse export decodes back to the dense masked volume,
+    including runs which touch the edges of a row.
+    """
+
+    self.delayDisplay("Starting the sparse export test")
+
+    rs = np.random.RandomState(5)
+    a = rs.randint(-1500, 1500, size=(9, 10, 12)).astype(np.int16)
+    lma = (rs.random_sample((9, 10, 12)) < 0.3).astype(np.uint8)
+    lma[:, 0, :] = 1
+    lma[:, 1, :] = 0
+    lma[:, 2, 0] = 1
+    lma[:, 2, -1] = 1
+    # a run across the end of a row
+    lma[:, 3, -1] = 1
+    lma[:, 4, 0] = 1
+    expected = np.where(lma == 1, a, -1001)[1:-1]
+
+    logic = MVTBinaryExportLogic()
+    fname = slicer.app.temporaryPath + '/MVTBinaryReaderTest-sparse.bin'
+    logic.export_array(fname, a, lma, (1.0, 1.0, 1.0), [None] * 4, slices_per_frame=2, encoding=ENCODING_SPARSE)
+
+    reader = MVTBinaryReader(fname)
+    self.assertEqual(reader.encoding, ENCODING_SPARSE)
+    self.assertEqual(reader.nframes, 4)
+    self.assertTrue(np.array_equal(reader.frame(3), expected[6:7]))
+    self.assertTrue(np.array_equal(reader.data, expected))
+    self.assertTrue(os.path.getsize(fname) < expected.nbytes)
+    self.delayDisplay('Test passed!')
+
+  def test_MVTBinaryExportLabels(self):
+    """ Check a multi-label export matches separate single-label exports.
+    """
+
+    self.delayDisplay("Starting the multi-label export test")
+
+    rs = np.random.RandomState(6)
+    a = rs.randint(-1500, 1500, size=(8, 6, 5)).astype(np.int16)
+    lma = rs.randint(0, 4, size=(8, 6, 5)).astype(np.uint8)
+
+    # counts the slabs read from the volume
+    reads = []
+    class CountingArray(np.ndarray):
+      def __getitem__(self, key):
+        if isinstance(key, slice):
+          reads.append(key)
+        return np.ndarray.__getitem__(self.view(np.ndarray), key)
+
+    logic = MVTBinaryExportLogic()
+    base = slicer.app.temporaryPath + '/MVTBinaryExportLabelsTest.bin'
+    for encoding in (ENCODING_RAW, ENCODING_ZLIB, ENCODING_SPARSE):
+      fnames = dict((label, logic.label_filename(base, label)) for label in (1, 2, 3))
+      del reads[:]
+      logic.export_labels(fnames, a.view(CountingArray), lma, (1.0, 1.0, 1.0), [None] * 4, slices_per_frame=2, encoding=encoding)
+      # one chunk for the raw writer, one per frame when encoding
+      self.assertEqual(len(reads), 1 if encoding == ENCODING_RAW else 2)
+      for label in (1, 2, 3):
+        reader = MVTBinaryReader(fnames[label])
+        self.assertEqual(reader.encoding, encoding)
+        self.assertEqual(reader.nframes, 2)
+        self.assertTrue(np.array_equal(reader.data, np.where(lma == label, a, -1001)[1:5]))
+    self.delayDisplay('Test passed!')
+
+  def test_MVTBinaryExportCache(self):
+    """ Check unchanged exports are skipped and changed ones are rewritten.
+    """
+
+    self.delayDisplay("Starting the export cache test")
+
+    rs = np.random.RandomState(7)
+    a = rs.randint(-1500, 1500, size=(6, 5, 4)).astype(np.int16)
+    lma = rs.randint(0, 2, size=(6, 5, 4)).astype(np.uint8)
+    fname = slicer.app.temporaryPath + '/MVTBinaryExportCacheTest.bin'
+    if os.path.exists(fname + '.manifest'):
+      os.remove(fname + '.manifest')
+
+    logic = MVTBinaryExportLogic()
+    job = {'fnames': {1: fname}, 'a': a, 'lma': lma, 'spacing': (1.0, 1.0, 1.0), 'strings': [None] * 4,
+      'slices_per_frame': None, 'padded': True, 'encoding': ENCODING_RAW, 'mtimes': [1, 2, 3, 4, SESSION_TOKEN]}
+    self.assertEqual(logic.export_cached(job), [])
+    self.assertEqual(logic.export_cached(job), [1])
+    self.assertEqual(logic.export_cached(job, force=True), [])
+
+    # new modification times but the same voxels
+    job['mtimes'] = [5, 6, 7, 8, SESSION_TOKEN]
+    self.assertEqual(logic.export_cached(job), [1])
+
+    # a changed voxel inside the mask is only noticed once the modification
+    #  times change, as they do whenever a node's image data is edited
+    a[lma == 1] += 1
+    self.assertEqual(logic.export_cached(job), [1])
+    job['mtimes'] = [9, 10, 11, 12, SESSION_TOKEN]
+    self.assertEqual(logic.export_cached(job), [])
+    self.assertTrue(np.array_equal(MVTBinaryReader(fname).data, np.where(lma == 1, a, -1001)[1:-1]))
+
+    # another process can see the same modification times for different data
+    a[lma == 1] += 1
+    job['mtimes'] = [9, 10, 11, 12, 'another session']
+    self.assertEqual(logic.export_cached(job), [])
+    self.assertTrue(np.array_equal(MVTBinaryReader(fname).data, np.where(lma == 1, a, -1001)[1:-1]))
+    self.delayDisplay('Test passed!')
+
+  def test_MVTBinaryExportDigests(self):
+    """ Check the digests hashed while exporting match content_digests for
+    every encoding.
+    """
+
+    self.delayDisplay("Starting the export digests test")
+
+    rs = np.random.RandomState(10)
+    a = rs.randint(-1500, 1500, size=(12, 5, 4)).astype(np.int16)
+    lma = rs.randint(0, 3, size=(12, 5, 4)).astype(np.uint8)
+    base = slicer.app.temporaryPath + '/MVTBinaryExportDigestsTest.bin'
+
+    logic = MVTBinaryExportLogic()
+    for encoding in (ENCODING_RAW, ENCODING_ZLIB, ENCODING_SPARSE):
+      job = logic.build_job(base, a, lma, (1.0, 1.0, 1.0), {}, 3, True, True, encoding, [1, 2], [])
+      digests = {}
+      logic.export_labels(job['fnames'], a, lma, (1.0, 1.0, 1.0), job['strings'], max_memory=1024,
+        slices_per_frame=job['slices_per_frame'], encoding=encoding, digests=digests)
+      self.assertEqual(digests, logic.content_digests(job, [1, 2]))
+    self.delayDisplay('Test passed!')
+
+  def test_MVTBinaryExportBatchFiles(self):
+    """ Check batch jobs sharing an output file are refused and that results
+    are reported per file.
+    """
+
+    self.delayDisplay("Starting the batch files test")
+
+    rs = np.random.RandomState(9)
+    a = rs.randint(-1500, 1500, size=(6, 5, 4)).astype(np.int16)
+    lma = rs.randint(0, 3, size=(6, 5, 4)).astype(np.uint8)
+    fname = slicer.app.temporaryPath + '/MVTBinaryExportBatchTest.bin'
+
+    logic = MVTBinaryExportLogic()
+    job = logic.build_job(fname, a, lma, (1.0, 1.0, 1.0), {}, 1, True, False, ENCODING_RAW, [1, 2], [])
+    other = logic.build_job(fname, a, lma, (1.0, 1.0, 1.0), {}, 1, True, False, ENCODING_RAW, [2], [])
+    self.assertRaises(ValueError, logic.check_batch_files, [job, other])
+
+    results = logic.export_timed(job, force=True)
+    self.assertEqual([result['file'] for result in results], [logic.label_filename(fname, 1), logic.label_filename(fname, 2)])
+    for result in results:
+      self.assertFalse(result['skipped'])
+      self.assertEqual(result['bytes'], os.path.getsize(result['file']))
+    self.delayDisplay('Test passed!')
+
+  def test_MVTBinaryExportMultiVolume(self):
+    """ Check exporting straight from a MultiVolume array matches exporting the
+    concatenated volume MVTConvert would build.
+    """
+
+    self.delayDisplay("Starting the fused MultiVolume export test")
+
+    rs = np.random.RandomState(8)
+    a4 = rs.randint(-1500, 1500, size=(2, 5, 4, 7)).astype(np.int16)
+    sframe, nframes, finterval, zslices = 2, 4, 3, 2
+
+    # the concatenated volume as MVTConvertLogic.run builds it
+    a = MVTConvertLogic().convertArray(a4, sframe, nframes, finterval, zslices)
+    lma = rs.randint(0, 2, size=a.shape).astype(np.uint8)
+
+    logic = MVTBinaryExportLogic()
+    fname_converted = slicer.app.temporaryPath + '/MVTBinaryExportMVTest-converted.bin'
+    fname_fused = slicer.app.temporaryPath + '/MVTBinaryExportMVTest-fused.bin'
+    logic.export_array(fname_converted, a, lma, (1.0, 1.0, 1.0), [None] * 4, max_memory=1)
+    fused = ConcatenatedFrames(a4, sframe, nframes, finterval, zslices)
+    self.assertEqual(fused.shape, a.shape)
+    self.assertTrue(np.array_equal(fused[0:len(fused)], a))
+    logic.export_array(fname_fused, fused, lma, (1.0, 1.0, 1.0), [None] * 4, max_memory=1)
+
+    self.assertEqual(open(fname_converted, 'rb').read(), open(fname_fused, 'rb').read())
+    self.delayDisplay('Test passed!')
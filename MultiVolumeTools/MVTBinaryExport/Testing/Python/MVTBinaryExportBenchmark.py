@@ -0,0 +1,103 @@
+"""Benchmark the MVTBinaryExport writers on synthetic volumes.
+
+Drives MVTBinaryExportLogic.export_array directly on synthetic int16 volumes
+and label maps, so no scene or GUI is involved.  For every combination of
+slice size, number of frames, mask fill fraction and encoding it reports
+throughput (MB/s of uncompressed voxel data), the peak memory allocated by
+the writer and the ratio of voxel data to file size.  Baselines are saved
+and compared as described in MVTBenchmark.  Run it with Slicer's Python so
+that the module imports resolve, e.g.
+
+  Slicer --no-main-window --python-script MVTBinaryExportBenchmark.py --save baseline.json
+  Slicer --no-main-window --python-script MVTBinaryExportBenchmark.py --compare baseline.json
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import itertools
+import numpy as np
+
+MODULE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..')
+sys.path.insert(0, MODULE_DIR)
+# MVTBinaryExport imports MVTConvert, which Slicer would find as a sibling
+#  module, and the benchmark harness is kept with MVTConvert's benchmark
+sys.path.insert(0, os.path.join(MODULE_DIR, '..', 'MVTConvert'))
+sys.path.insert(0, os.path.join(MODULE_DIR, '..', 'MVTConvert', 'Testing', 'Python'))
+from MVTBinaryExport import MVTBinaryExportLogic, ENCODING_RAW, ENCODING_ZLIB, ENCODING_SPARSE
+import MVTBenchmark
+
+ENCODINGS = (('raw', ENCODING_RAW), ('zlib', ENCODING_ZLIB), ('sparse', ENCODING_SPARSE))
+
+# (slice sizes, frames, fill fractions) for the full and --quick grids
+FULL_GRID = ((128, 256, 512), (10, 50, 200), (0.1, 0.2, 0.5))
+QUICK_GRID = ((128, 256), (10, 50), (0.15,))
+
+SLICES_PER_FRAME = 1
+KEY_FIELDS = ('size', 'frames', 'fill', 'encoding')
+
+
+def synthetic_volume(shape, fill, seed = 0):
+  """Return a padded [z][y][x] int16 volume of lung-like noise and a label map
+  whose elliptical mask covers roughly fill of each slice.
+  """
+  rs = np.random.RandomState(seed)
+  a = rs.randint(-1000, 100, size=shape).astype(np.int16)
+
+  radius = np.sqrt(fill / np.pi)
+  y = (np.arange(shape[1]) + 0.5) / shape[1] - 0.5
+  x = (np.arange(shape[2]) + 0.5) / shape[2] - 0.5
+  ellipse = (y[:, None] ** 2 + x[None, :] ** 2) <= radius ** 2
+  lma = np.zeros(shape, dtype=np.uint8)
+  lma[:] = ellipse
+  return a, lma
+
+
+def export(logic, fname, a, lma, encoding):
+  logic.export_array(fname, a, lma, (1.0, 1.0, 1.0), [None] * 4, slices_per_frame=SLICES_PER_FRAME, encoding=encoding)
+
+
+def run_grid(grid, repeats):
+  logic = MVTBinaryExportLogic()
+  tmpdir = tempfile.mkdtemp()
+  results = []
+  try:
+    for size, frames, fill in itertools.product(*grid):
+      shape = (frames * SLICES_PER_FRAME + 2, size, size)
+      a, lma = synthetic_volume(shape, fill)
+      payload = (shape[0] - 2) * size * size * 2
+
+      for name, encoding in ENCODINGS:
+        fname = os.path.join(tmpdir, name + '.bin')
+        args = (logic, fname, a, lma, encoding)
+        elapsed = min(MVTBenchmark.time_call(export, *args)[0] for r in range(0, repeats))
+        peak = MVTBenchmark.peak_memory(export, *args)
+        result = {
+          'size': size,
+          'frames': frames,
+          'fill': fill,
+          'encoding': name,
+          'seconds': elapsed,
+          'mb_per_s': payload / elapsed / 1e6,
+          'peak_mb': peak / 1e6,
+          'ratio': float(payload) / os.path.getsize(fname),
+          }
+        results.append(result)
+        print('%5d %6d %5.2f %-7s %9.3f %9.1f %9.1f %7.2f' % (size, frames, fill, name,
+          result['seconds'], result['mb_per_s'], result['peak_mb'], result['ratio']))
+        sys.stdout.flush()
+  finally:
+    shutil.rmtree(tmpdir)
+  return results
+
+
+def main(argv):
+  return MVTBenchmark.main(argv, 'Benchmark the MVTBinaryExport writers.',
+    'exports per configuration; the fastest is reported',
+    '%5s %6s %5s %-7s %9s %9s %9s %7s' % ('size', 'frames', 'fill', 'writer', 'seconds', 'MB/s', 'peak MB', 'ratio'),
+    run_grid, FULL_GRID, QUICK_GRID, KEY_FIELDS, '%5d %6d %5.2f %-7s')
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv[1:]))
@@ -3,7 +3,33 @@ import unittest
 import vtk, qt, ctk, slicer
 from slicer.ScriptedLoadableModule import *
 import logging
+import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import numpy as np
+try:
+  import pydicom
+except ImportError:
+  pydicom = None
+
+# DICOM tags copied to the pig_dyn attributes of converted volumes
+HEADER_TAGS = {
+  'pig_dyn.AcquisitionDateTime': '0008,002a',
+  'pig_dyn.SeriesName': '0020,0011',
+  'pig_dyn.PatientName': '0010,0010',
+  }
+
+# Header values already looked up this session, by instance UID
+_headerCache = {}
+
+# Output frames copied by each task when converting on a thread pool
+DEFAULT_FRAMES_PER_BLOCK = 32
+
+# Node modification times are counters local to one process, and a scripted
+#  run which loads the same data in the same order sees the same values (and
+#  often the same PID).  Modules which store modification times to compare in
+#  a later run store this random token with them, so they are only ever
+#  compared within the process which recorded them.
+SESSION_TOKEN = uuid.uuid4().hex
 
 #
 # MVTConvert
@@ -106,6 +132,16 @@ class MVTConvertWidget(ScriptedLoadableModuleWidget):
     self.zslices.text = '1'
     parametersFormLayout.addRow("ZSlices per frame: ", self.zslices)
     
+    self.stride = qt.QLineEdit()
+    self.stride.text = '1'
+    self.stride.setToolTip( "Keep only every n-th of the selected frames." )
+    parametersFormLayout.addRow("Temporal stride: ", self.stride)
+    
+    self.roi = qt.QLineEdit()
+    self.roi.text = ''
+    self.roi.setToolTip( "Crop to IJK columns Imin to Imax - 1 and rows Jmin to Jmax - 1, given as 'Imin Imax Jmin Jmax'.  Leave blank for the whole field of view." )
+    parametersFormLayout.addRow("ROI (Imin Imax Jmin Jmax): ", self.roi)
+    
     self.pad = qt.QCheckBox()
     self.pad.setChecked(False)
     parametersFormLayout.addRow("Pad with blank frame: ", self.pad)
@@ -148,7 +184,10 @@ class MVTConvertWidget(ScriptedLoadableModuleWidget):
 
   def onApplyButton(self):
     logic = MVTConvertLogic()
-    logic.run(self.inputSelector.currentNode(), self.ovol.currentNode(), int(self.sframe.text), int(self.nframes.text), int(self.finterval.text), int(self.zslices.text), self.pad.isChecked(), self.createLabel.isChecked(), self.progbar)
+    roi = None
+    if self.roi.text.strip():
+      roi = [int(v) for v in self.roi.text.split()]
+    logic.run(self.inputSelector.currentNode(), self.ovol.currentNode(), int(self.sframe.text), int(self.nframes.text), int(self.finterval.text), int(self.zslices.text), self.pad.isChecked(), self.createLabel.isChecked(), self.progbar, roi, int(self.stride.text))
 
 #
 # pig_dynLogic
@@ -228,21 +267,197 @@ class MVTConvertLogic(ScriptedLoadableModuleLogic):
     annotationLogic = slicer.modules.annotations.logic()
     annotationLogic.CreateSnapShot(name, description, type, 1, imageData) 
 
-  def run(self, input_vol, output_vol, sframe, nframes, finterval, zslices, to_pad = True, create_label = False, pb = None):
+  def multiVolumeArray(self, input_vol):
+    """Return a [z][y][x][frame] view onto the scalars of a MultiVolume node
+    without copying
+    """
+    import vtk.util.numpy_support
+    im = input_vol.GetImageData()
+    shape = list(im.GetDimensions())
+    shape.reverse()
+    shape.append(im.GetNumberOfScalarComponents())
+    return vtk.util.numpy_support.vtk_to_numpy(im.GetPointData().GetScalars()).reshape(shape)
+
+  def sourceIndices(self, max_z, sframe, nframes, finterval):
+    """For each output frame, the slice (src_t) and frame (src_z) of the
+    MultiVolume it is copied from, where max_z is the number of frames in the
+    MultiVolume
+    """
+    src_index = sframe + np.arange(nframes) * finterval
+    return src_index // max_z, src_index % max_z
+
+  def gatherFrames(self, a, da, sframe, nframes, finterval, zslices, offset_frame, frames_per_block = DEFAULT_FRAMES_PER_BLOCK, threads = None, pb = None, roi = None):
+    """Fill the [z][y][x] array da with the selected frames of the
+    [z][y][x][frame] MultiVolume array a, each repeated zslices times, after
+    offset_frame padding slices.  The padding slices are zeroed.  Blocks of
+    frames_per_block output frames are copied on a pool of threads; progress
+    is reported from the calling thread as each block completes.  If given,
+    roi = (imin, imax, jmin, jmax) crops each frame to columns imin to imax - 1
+    and rows jmin to jmax - 1, and da must have the cropped size.
+    """
+    if roi is None:
+      roi = (0, a.shape[2], 0, a.shape[1])
+    imin, imax, jmin, jmax = roi
+    if threads is None:
+      threads = os.cpu_count() or 1
+    src_ts, src_zs = self.sourceIndices(a.shape[3], sframe, nframes, finterval)
+    end = offset_frame + nframes * zslices
+    da[:offset_frame] = 0
+    da[end:] = 0
+    frames = da[offset_frame:end].reshape(nframes, zslices, da.shape[1], da.shape[2])
+
+    pool = ThreadPoolExecutor(max_workers=threads)
+    try:
+      futures = [pool.submit(self.gatherBlock, a, frames, src_ts, src_zs, start, min(start + frames_per_block, nframes), slice(jmin, jmax), slice(imin, imax))
+        for start in range(0, nframes, frames_per_block)]
+      done = 0
+      for future in as_completed(futures):
+        done += future.result()
+        if pb is None:
+          pass
+        else:
+          pb.setValue(done * 100 // nframes)
+          slicer.app.processEvents()
+    finally:
+      pool.shutdown()
+
+  def gatherBlock(self, a, frames, src_ts, src_zs, start, stop, rows = slice(None), columns = slice(None)):
+    """Copy output frames start to stop - 1, cropped to rows and columns, into
+    the [frame][zslices][y][x] array frames and return how many were copied.
+    Called from worker threads; the blocks do not overlap.
+    """
+    # one fancy-index gathers every source slice as [fid][y][x], touching only
+    # the cropped rows and columns; the zslices repeats are a broadcast along
+    # the second axis of the destination
+    frames[start:stop] = a[src_ts[start:stop], rows, columns, src_zs[start:stop]][:, np.newaxis]
+    return stop - start
+
+  def frameAttributes(self, input_vol, database = None):
+    """The pig_dyn attributes describing where a MultiVolume came from, for
+    eventually exporting with MVTBinaryExport
+    """
+    instUids = input_vol.GetAttribute('DICOM.instanceUIDs').split()
+    header = self.dicomHeader(instUids[0], database)
+    attributes = dict((attr, header[tag]) for attr, tag in HEADER_TAGS.items())
+    attributes['pig_dyn.SourceName'] = input_vol.GetName()
+    return attributes
+
+  def frameLayout(self, volume):
+    """Slices per frame and whether a volume is padded, as recorded by run.
+    Volumes converted before these attributes were recorded (which still have
+    pig_dyn.SourceName) are taken to have run's defaults of one padded slice
+    per frame.  Volumes not converted by MVTConvert are a single unpadded
+    frame.
+    """
+    slices_per_frame = volume.GetAttribute('pig_dyn.ZSlices')
+    if slices_per_frame is not None:
+      return int(slices_per_frame), volume.GetAttribute('pig_dyn.Padded') != '0'
+    if volume.GetAttribute('pig_dyn.SourceName') is not None:
+      return 1, True
+    return volume.GetImageData().GetDimensions()[2], False
+
+  def dicomHeader(self, instUid, database = None):
+    """Return the HEADER_TAGS values of a DICOM instance as a dict by tag.
+    database defaults to slicer.dicomDatabase but may be anything providing
+    fileForInstance and fileValue.  Results are cached for the session, as
+    every frame of a series shares the instance looked up.
+    """
+    if instUid in _headerCache:
+      return _headerCache[instUid]
+    if database is None:
+      database = slicer.dicomDatabase
+    filename = database.fileForInstance(instUid)
+    header = self.readHeader(filename)
+    if header is None:
+      header = dict((tag, database.fileValue(filename, tag)) for tag in HEADER_TAGS.values())
+    _headerCache[instUid] = header
+    return header
+
+  def readHeader(self, filename):
+    """Read all of HEADER_TAGS from filename in a single pass with pydicom,
+    or return None if pydicom is unavailable or cannot read the file
+    """
+    if pydicom is None or not os.path.isfile(filename):
+      return None
+    tags = dict((tag, pydicom.tag.Tag(*[int(part, 16) for part in tag.split(',')])) for tag in HEADER_TAGS.values())
+    try:
+      ds = pydicom.dcmread(filename, stop_before_pixels=True, specific_tags=list(tags.values()))
+    except (IOError, pydicom.errors.InvalidDicomError):
+      return None
+    return dict((tag, str(ds[t].value) if t in ds else '') for tag, t in tags.items())
+
+  def clearHeaderCache(self):
+    """Forget the DICOM header values cached by dicomHeader
+    """
+    _headerCache.clear()
+
+  def checkRoi(self, roi, max_x, max_y):
+    """Validate an (imin, imax, jmin, jmax) crop of a max_x by max_y field of
+    view, returning the whole field of view for None
+    """
+    if roi is None:
+      return (0, max_x, 0, max_y)
+    imin, imax, jmin, jmax = roi
+    if not (0 <= imin < imax <= max_x and 0 <= jmin < jmax <= max_y):
+      raise ValueError('ROI %s is empty or outside the %d x %d field of view' % (str(tuple(roi)), max_x, max_y))
+    return (imin, imax, jmin, jmax)
+
+  def concatenatedFrames(self, input_vol, sframe, nframes, finterval, zslices, to_pad = True):
+    """The volume run would build from a MultiVolume node, as a
+    ConcatenatedFrames over its buffer rather than a new vtkImageData.  This
+    shares memory with the MultiVolume where the frame selection allows.
+    """
+    a = self.multiVolumeArray(input_vol)
+    if nframes == -1:
+      nframes = a.shape[0] * a.shape[3]
+    return ConcatenatedFrames(a, sframe, nframes, finterval, zslices, to_pad)
+
+  def frameSelection(self, shape, sframe, nframes, finterval, zslices, to_pad = True, roi = None, stride = 1):
+    """Resolve the frame selection for a [z][y][x][frame] array of the given
+    shape.  Returns the number of output frames, the frame interval after
+    applying stride, the (imin, imax, jmin, jmax) crop, the number of padding
+    slices at each end and the [z][y][x] shape of the output.
+    """
+    max_t, max_y, max_x, max_z = shape
+    if nframes == -1:
+      nframes = max_t * max_z
+
+    # keeping every stride-th selected frame is a longer frame interval
+    nframes = (nframes + stride - 1) // stride
+    finterval = finterval * stride
+    roi = self.checkRoi(roi, max_x, max_y)
+
+    # Add 2 extra frames (one at start and one at end) to enable segregation using
+    # LevelTracingEffect
+    offset_frame = 1 if to_pad else 0
+    out_shape = (zslices * (nframes + 2 * offset_frame), roi[3] - roi[2], roi[1] - roi[0])
+    return nframes, finterval, roi, offset_frame, out_shape
+
+  def convertArray(self, a, sframe, nframes, finterval, zslices, to_pad = True, roi = None, stride = 1, out = None, frames_per_block = DEFAULT_FRAMES_PER_BLOCK, threads = None, pb = None):
+    """The conversion done by run on a plain [z][y][x][frame] NumPy array,
+    returning the concatenated [z][y][x] volume.  out is filled if given and
+    must have the output shape from frameSelection.
+    """
+    nframes, finterval, roi, offset_frame, out_shape = self.frameSelection(a.shape, sframe, nframes, finterval, zslices, to_pad, roi, stride)
+    if out is None:
+      out = np.empty(out_shape, dtype=a.dtype)
+    elif out.shape != out_shape:
+      raise ValueError('output shape %s does not match %s' % (str(out.shape), str(out_shape)))
+    self.gatherFrames(a, out, sframe, nframes, finterval, zslices, offset_frame, frames_per_block, threads, pb, roi)
+    return out
+
+  def run(self, input_vol, output_vol, sframe, nframes, finterval, zslices, to_pad = True, create_label = False, pb = None, roi = None, stride = 1):
     """
-    Run the actual algorithm
+    Run the actual algorithm.  roi = (imin, imax, jmin, jmax) crops every
+    frame to that box in IJK and stride keeps only every stride-th selected
+    frame; neither the cropped nor the skipped data is copied.
     """
 
     logging.info('Processing started')
 
     a = slicer.util.array(input_vol.GetName())
-    max_t = len(a)
-    max_y = len(a[0])
-    max_x = len(a[0][0])
-    max_z = len(a[0][0][0])
-
-    if nframes == -1:
-      nframes = max_t * max_z
+    out_frames, out_interval, roi, offset_frame, out_shape = self.frameSelection(a.shape, sframe, nframes, finterval, zslices, to_pad, roi, stride)
+    imin, imax, jmin, jmax = roi
 
     vl = slicer.modules.volumes.logic()
 	
@@ -253,21 +468,12 @@ class MVTConvertLogic(ScriptedLoadableModuleLogic):
       slicer.app.processEvents()
       
     # Get some information about the input volume for eventually exporting
-    instUids = input_vol.GetAttribute('DICOM.instanceUIDs').split()
-    filename = slicer.dicomDatabase.fileForInstance(instUids[0])
-    output_vol.SetAttribute('pig_dyn.AcquisitionDateTime', slicer.dicomDatabase.fileValue(filename, '0008,002a'))
-    output_vol.SetAttribute('pig_dyn.SourceName', input_vol.GetName())
-    output_vol.SetAttribute('pig_dyn.SeriesName', slicer.dicomDatabase.fileValue(filename, '0020,0011'))
-    output_vol.SetAttribute('pig_dyn.PatientName', slicer.dicomDatabase.fileValue(filename, '0010,0010'))
+    for attr, value in self.frameAttributes(input_vol).items():
+      output_vol.SetAttribute(attr, value)
+    output_vol.SetAttribute('pig_dyn.ZSlices', '%d' % zslices)
+    output_vol.SetAttribute('pig_dyn.Padded', '1' if to_pad else '0')
     
-    # Add 2 extra frames (one at start and one at end) to enable segregation using
-    # LevelTracingEffect
-    
-    total_frames = nframes
-    if(to_pad):
-      total_frames = total_frames + 2
-    
-    imageSize=[max_x, max_y, zslices * total_frames]
+    imageSize=list(out_shape[::-1])
     imageSpacing=input_vol.GetSpacing()
     voxelType=vtk.VTK_SHORT
     # Create an empty image volume
@@ -279,10 +485,6 @@ class MVTConvertLogic(ScriptedLoadableModuleLogic):
     output_scalars = imageData.GetPointData().GetScalars()
     da = vtk.util.numpy_support.vtk_to_numpy(output_scalars).reshape(imageSize[::-1])
     #da = slicer.util.array(volumeNode.GetID())
-   
-    offset_frame = 0
-    if(to_pad):
-      offset_frame = 1
     
     #for fid in xrange(0, nframes):
     #  for z in xrange(0, zslices):
@@ -293,26 +495,8 @@ class MVTConvertLogic(ScriptedLoadableModuleLogic):
     #        src_z = src_index % max_z
     #        da[z + fid * zslices + offset_frame][y][x] = a[src_t][y][x][src_z]
 
-    for fid in xrange(0, nframes):
-      for z in xrange(0, zslices):
-        src_index = sframe + fid * finterval
-        src_t = src_index // max_z
-        src_z = src_index % max_z
-
-        # a has the shape [z][y][x][frame]
-        # we want it to go to [y][x]
-
-        a_tpose = np.transpose(a[src_t])  # a_tpose = [frame][x][y]
-        a_tposeb = np.transpose(a_tpose[src_z]) # a_tposeb = [y][x]
-        da[z + fid * zslices + offset_frame][:][:] = a_tposeb
-      
-      logging.info('Processed frame %d' % fid)
-	  
-      if pb is None:
-        pass
-      else:
-        pb.setValue((fid + 1) * 100 / nframes)
-        slicer.app.processEvents()
+    self.convertArray(a, sframe, nframes, finterval, zslices, to_pad, roi, stride, out=da, pb=pb)
+    logging.info('Processed %d frames' % out_frames)
 
     imageData.Modified()
     
@@ -327,7 +511,10 @@ class MVTConvertLogic(ScriptedLoadableModuleLogic):
     #vname = output_vol;
     #volumeNode.SetName(vname)
     volumeNode.SetSpacing(imageSpacing)
-    volumeNode.SetOrigin(input_vol.GetOrigin())
+    # the output starts at IJK (imin, jmin, 0) of the input
+    ijkToRas = vtk.vtkMatrix4x4()
+    input_vol.GetIJKToRASMatrix(ijkToRas)
+    volumeNode.SetOrigin(ijkToRas.MultiplyPoint((imin, jmin, 0, 1))[:3])
     vm = vtk.vtkMatrix4x4()
     input_vol.GetIJKToRASDirectionMatrix(vm)
     volumeNode.SetIJKToRASDirectionMatrix(vm)
@@ -361,6 +548,104 @@ class MVTConvertLogic(ScriptedLoadableModuleLogic):
     return True
 
 
+#
+# ConcatenatedFrames
+#
+
+class ConcatenatedFrames(object):
+  """The [z][y][x] volume MVTConvertLogic.run would build from a [z][y][x][frame]
+  MultiVolume array, without building it.  Output slices are gathered from the
+  MultiVolume only when indexed along z, so consumers can stream the
+  concatenated volume a chunk at a time.  Padding slices read as zero.
+
+  When the selected frames lie a constant distance apart in the MultiVolume's
+  buffer, frames is a read-only [frame][zslice][y][x] view of the buffer, with
+  the zslices repeats at stride 0, and indexing returns views into it rather
+  than copies wherever the result can be expressed as strides.  Otherwise, or
+  for ranges including padding, the slices are copied.  Use np.array for a
+  contiguous copy, e.g. to hand to vtkImageData.
+  """
+
+  def __init__(self, a, sframe, nframes, finterval, zslices, to_pad = True):
+    self.a = a
+    self.nframes = nframes
+    self.zslices = zslices
+    self.offset = 1 if to_pad else 0
+    self.src_t, self.src_z = MVTConvertLogic().sourceIndices(a.shape[3], sframe, nframes, finterval)
+    # as in run, the padding is a whole frame of zslices at each end, of which
+    # only the first slice precedes the data
+    self.shape = (zslices * (nframes + 2 * self.offset), a.shape[1], a.shape[2])
+    self.dtype = a.dtype
+    self.ndim = 3
+    self.frames = self.stridedFrames()
+
+  def __len__(self):
+    return self.shape[0]
+
+  def __array__(self, dtype = None, copy = None):
+    if copy is False:
+      raise ValueError('ConcatenatedFrames cannot be converted to an array without a copy')
+    out = self.gather(np.arange(self.shape[0]))
+    return out if dtype is None else out.astype(dtype, copy=False)
+
+  def __getitem__(self, key):
+    if isinstance(key, slice):
+      start, stop, step = key.indices(self.shape[0])
+      view = self.view(start, stop, step)
+      if view is not None:
+        return view
+      return self.gather(np.arange(start, stop, step))
+    if key < 0:
+      key += self.shape[0]
+    if not 0 <= key < self.shape[0]:
+      raise IndexError('slice index out of range')
+    z = key - self.offset
+    if self.frames is not None and 0 <= z < self.nframes * self.zslices:
+      return self.frames[z // self.zslices, z % self.zslices]
+    return self.gather(np.array([key]))[0]
+
+  def stridedFrames(self):
+    """Return a read-only [frame][zslice][y][x] view of the selected frames,
+    or None if they are not evenly spaced in memory
+    """
+    if self.nframes == 0:
+      return None
+    offsets = self.src_t * self.a.strides[0] + self.src_z * self.a.strides[3]
+    steps = np.diff(offsets)
+    if len(steps) > 0 and (steps != steps[0]).any():
+      return None
+    first = self.a[self.src_t[0], :, :, self.src_z[0]]
+    return np.lib.stride_tricks.as_strided(first, shape=(self.nframes, self.zslices) + first.shape,
+      strides=(int(steps[0]) if len(steps) > 0 else 0, 0) + first.strides, writeable=False)
+
+  def view(self, start, stop, step):
+    """A view of output slices start to stop - 1 in steps of step, or None
+    if the range includes padding or needs a copy.  Only a range within one
+    frame, or one slice per frame, can be expressed as strides.
+    """
+    z_start = start - self.offset
+    z_stop = stop - self.offset
+    if self.frames is None or step != 1 or z_start < 0 or z_stop > self.nframes * self.zslices or z_start >= z_stop:
+      return None
+    if self.zslices == 1:
+      return self.frames[z_start:z_stop, 0]
+    fid = z_start // self.zslices
+    if (z_stop - 1) // self.zslices == fid:
+      return self.frames[fid, z_start % self.zslices:(z_stop - 1) % self.zslices + 1]
+    return None
+
+  def gather(self, z):
+    """Copy of the output slices in the 1-d index array z
+    """
+    fid = (z - self.offset) // self.zslices
+    blank = (z < self.offset) | (fid >= self.nframes)
+    fid = np.clip(fid, 0, self.nframes - 1)
+    # index arrays on both axes, so this is always a copy
+    out = self.a[self.src_t[fid], :, :, self.src_z[fid]]
+    out[blank] = 0
+    return out
+
+
 class MVTConvertTest(ScriptedLoadableModuleTest):
   """
   This is the test case for your scripted module.
@@ -378,6 +663,10 @@ class MVTConvertTest(ScriptedLoadableModuleTest):
     """
     self.setUp()
     self.test_MVTConvert1()
+    self.test_MVTConvertGather()
+    self.test_MVTConvertHeaderCache()
+    self.test_MVTConvertView()
+    self.test_MVTConvertFrameLayout()
 
   def test_MVTConvert1(self):
     """ Ideally you should have several levels of tests.  At the lowest level
@@ -414,3 +703,157 @@ class MVTConvertTest(ScriptedLoadableModuleTest):
     logic = pig_dynLogic()
     self.assertTrue( logic.hasImageData(volumeNode) )
     self.delayDisplay('Test passed!')
+
+  def test_MVTConvertGather(self):
+    """ Check the vectorized frame gather against copying one slice at a time.
+    """
+
+    self.delayDisplay("Starting the frame gather test")
+
+    rs = np.random.RandomState(12)
+    a = rs.randint(-1500, 1500, size=(3, 5, 4, 7)).astype(np.int16)
+    logic = MVTConvertLogic()
+
+    for sframe, nframes, finterval, zslices, offset_frame in ((0, 21, 1, 1, 1), (2, 5, 4, 3, 1), (6, 4, 2, 2, 0)):
+      expected = np.zeros((nframes * zslices + 2 * offset_frame, 5, 4), dtype=np.int16)
+      for fid in range(0, nframes):
+        src_index = sframe + fid * finterval
+        for z in range(0, zslices):
+          expected[z + fid * zslices + offset_frame] = a[src_index // 7, :, :, src_index % 7]
+
+      da = np.empty_like(expected)
+      da.fill(99)
+      logic.gatherFrames(a, da, sframe, nframes, finterval, zslices, offset_frame)
+      self.assertTrue(np.array_equal(da, expected))
+
+      # small blocks on several threads, including a short final block
+      da.fill(99)
+      logic.gatherFrames(a, da, sframe, nframes, finterval, zslices, offset_frame, frames_per_block=2, threads=3)
+      self.assertTrue(np.array_equal(da, expected))
+
+      # cropped to columns 1-2 and rows 2-4
+      da = np.empty_like(expected[:, 2:5, 1:3])
+      logic.gatherFrames(a, da, sframe, nframes, finterval, zslices, offset_frame, frames_per_block=3, roi=(1, 3, 2, 5))
+      self.assertTrue(np.array_equal(da, expected[:, 2:5, 1:3]))
+
+    # the whole conversion on a plain array, cropped and decimated
+    expected = np.zeros((2 * (3 + 2), 5, 4), dtype=np.int16)
+    logic.gatherFrames(a, expected, 1, 3, 4, 2, 1)
+    self.assertTrue(np.array_equal(logic.convertArray(a, 1, 5, 2, 2, stride=2), expected))
+    self.assertTrue(np.array_equal(logic.convertArray(a, 1, 5, 2, 2, to_pad=False, roi=(1, 3, 2, 5), stride=2), expected[1:-3, 2:5, 1:3]))
+    self.assertRaises(ValueError, logic.convertArray, a, 1, 5, 2, 2, out=expected)
+
+    self.assertEqual(logic.checkRoi(None, 4, 5), (0, 4, 0, 5))
+    self.assertRaises(ValueError, logic.checkRoi, (1, 5, 0, 5), 4, 5)
+    self.assertRaises(ValueError, logic.checkRoi, (2, 2, 0, 5), 4, 5)
+
+    self.delayDisplay('Test passed!')
+
+  def test_MVTConvertHeaderCache(self):
+    """ Check DICOM header values are looked up once per instance and reused.
+    """
+
+    self.delayDisplay("Starting the DICOM header cache test")
+
+    class FileDatabase(object):
+      """Stand-in for the DICOM database with header values held in a dict"""
+      def __init__(self, values):
+        self.values = values
+        self.lookups = 0
+      def fileForInstance(self, instUid):
+        return os.path.join(slicer.app.temporaryPath, 'missing', instUid + '.dcm')
+      def fileValue(self, filename, tag):
+        self.lookups += 1
+        return self.values[tag]
+
+    class Volume(object):
+      def __init__(self, name, uids):
+        self.name = name
+        self.uids = uids
+      def GetName(self):
+        return self.name
+      def GetAttribute(self, attr):
+        return self.uids
+
+    values = {'0008,002a': '20200102030405', '0020,0011': '7', '0010,0010': 'Pig^One'}
+    database = FileDatabase(values)
+    logic = MVTConvertLogic()
+    logic.clearHeaderCache()
+
+    attributes = logic.frameAttributes(Volume('dyn1', '1.2.3 1.2.4'), database)
+    self.assertEqual(attributes['pig_dyn.AcquisitionDateTime'], '20200102030405')
+    self.assertEqual(attributes['pig_dyn.SeriesName'], '7')
+    self.assertEqual(attributes['pig_dyn.PatientName'], 'Pig^One')
+    self.assertEqual(attributes['pig_dyn.SourceName'], 'dyn1')
+    lookups = database.lookups
+
+    # a second conversion of the same series goes nowhere near the database
+    attributes = logic.frameAttributes(Volume('dyn1 copy', '1.2.3'), database)
+    self.assertEqual(database.lookups, lookups)
+    self.assertEqual(attributes['pig_dyn.SourceName'], 'dyn1 copy')
+
+    logic.clearHeaderCache()
+    logic.frameAttributes(Volume('dyn1', '1.2.3'), database)
+    self.assertEqual(database.lookups, 2 * lookups)
+    self.delayDisplay('Test passed!')
+
+  def test_MVTConvertView(self):
+    """ Check the concatenated volume shares memory with the MultiVolume when
+    the frame selection allows, and matches the gathered copy either way.
+    """
+
+    self.delayDisplay("Starting the concatenated view test")
+
+    rs = np.random.RandomState(16)
+    a = rs.randint(-1500, 1500, size=(3, 5, 4, 7)).astype(np.int16)
+    logic = MVTConvertLogic()
+
+    # frames 1, 3, 5 of slice 0 and frames 0, 7, 14 (slice 0, 1, 2 at frame 0)
+    # are evenly spaced; frames 5, 8, 11 wrap between slices and are not
+    for sframe, nframes, finterval, zslices, strided in ((1, 3, 2, 3, True), (0, 3, 7, 1, True), (5, 3, 3, 2, False)):
+      expected = logic.convertArray(a, sframe, nframes, finterval, zslices)
+
+      f = ConcatenatedFrames(a, sframe, nframes, finterval, zslices)
+      self.assertEqual(f.frames is not None, strided)
+      self.assertTrue(np.array_equal(np.array(f), expected))
+      self.assertTrue(np.array_equal(np.asarray(f, dtype=np.float32), expected))
+      self.assertTrue(np.array_equal(f[0:len(f)], expected))
+      self.assertTrue(np.array_equal(f[-1], expected[-1]))
+      self.assertRaises(IndexError, f.__getitem__, len(f))
+      self.assertRaises(IndexError, f.__getitem__, -len(f) - 1)
+      for z in range(0, len(f)):
+        self.assertTrue(np.array_equal(f[z], expected[z]))
+        self.assertTrue(np.array_equal(f[z:z + 2], expected[z:z + 2]))
+      self.assertEqual(np.shares_memory(f[1], a), strided)
+      self.assertEqual(np.shares_memory(f[1:1 + zslices], a), strided)
+
+      if strided:
+        self.assertRaises(ValueError, f[1].fill, 0)
+
+    self.delayDisplay('Test passed!')
+
+  def test_MVTConvertFrameLayout(self):
+    """ Check the frame layout read back from a volume's attributes, for
+    current, older and unconverted volumes.
+    """
+
+    self.delayDisplay("Starting the frame layout test")
+
+    class ImageData(object):
+      def GetDimensions(self):
+        return (4, 3, 12)
+
+    class Volume(object):
+      def __init__(self, attributes):
+        self.attributes = attributes
+      def GetAttribute(self, attr):
+        return self.attributes.get(attr)
+      def GetImageData(self):
+        return ImageData()
+
+    logic = MVTConvertLogic()
+    self.assertEqual(logic.frameLayout(Volume({'pig_dyn.SourceName': 'dyn1', 'pig_dyn.ZSlices': '3', 'pig_dyn.Padded': '0'})), (3, False))
+    self.assertEqual(logic.frameLayout(Volume({'pig_dyn.SourceName': 'dyn1', 'pig_dyn.ZSlices': '3', 'pig_dyn.Padded': '1'})), (3, True))
+    self.assertEqual(logic.frameLayout(Volume({'pig_dyn.SourceName': 'dyn1'})), (1, True))
+    self.assertEqual(logic.frameLayout(Volume({})), (12, False))
+    self.delayDisplay('Test passed!')
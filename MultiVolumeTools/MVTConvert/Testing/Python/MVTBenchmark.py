@@ -0,0 +1,95 @@
+"""Command line harness shared by the MultiVolumeTools benchmarks.
+
+Each benchmark supplies its own parameter grids and a run_grid function that
+times every configuration and returns one dict of results per configuration.
+This module times and traces single calls, runs the grid from the command
+line, and saves or compares JSON baselines so that regressions between
+releases are visible.  Throughput is compared on each result's 'mb_per_s'.
+"""
+
+import sys
+import time
+import json
+import argparse
+import platform
+import tracemalloc
+import numpy as np
+
+
+def time_call(fn, *args):
+  """Call fn once and return the elapsed time and its result.  Memory is not
+  traced here, as tracing slows every allocation and would skew the timing.
+  """
+  start = time.time()
+  result = fn(*args)
+  return time.time() - start, result
+
+
+def peak_memory(fn, *args):
+  """Call fn once with allocations traced and return the peak memory
+  allocated during the call
+  """
+  tracemalloc.start()
+  try:
+    fn(*args)
+    return tracemalloc.get_traced_memory()[1]
+  finally:
+    tracemalloc.stop()
+
+
+def compare(results, baseline, key_fields, key_format, tolerance):
+  """Print the throughput change against a baseline and return the number of
+  configurations which are slower by more than tolerance.  key_format prints
+  the key_fields of a configuration.
+  """
+  previous = dict((tuple(r[k] for k in key_fields), r) for r in baseline['results'])
+  regressions = 0
+  print('\nChange in MB/s against baseline:')
+  for r in results:
+    key = tuple(r[k] for k in key_fields)
+    if key not in previous:
+      continue
+    change = r['mb_per_s'] / previous[key]['mb_per_s'] - 1.0
+    flag = ''
+    if change < -tolerance:
+      flag = '  REGRESSION'
+      regressions += 1
+    print((key_format + ' %+7.1f%%%s') % (key + (change * 100, flag)))
+  return regressions
+
+
+def main(argv, description, repeats_help, header, run_grid, full_grid, quick_grid, key_fields, key_format):
+  """Parse the benchmark options in argv, print header and run
+  run_grid(grid, repeats), then save or compare a baseline as requested.
+  Returns the process exit status, which is 1 if a regression was found.
+  """
+  parser = argparse.ArgumentParser(description=description)
+  parser.add_argument('--quick', action='store_true', help='run a smaller parameter grid')
+  parser.add_argument('--repeats', type=int, default=3, help=repeats_help)
+  parser.add_argument('--save', metavar='JSON', help='save the results as a baseline')
+  parser.add_argument('--compare', metavar='JSON', help='compare the results with a saved baseline')
+  parser.add_argument('--tolerance', type=float, default=0.2, help='fractional slowdown reported as a regression')
+  args = parser.parse_args(argv)
+
+  print(header)
+  results = run_grid(quick_grid if args.quick else full_grid, args.repeats)
+
+  if args.save:
+    baseline = {
+      'numpy': np.__version__,
+      'python': platform.python_version(),
+      'machine': platform.platform(),
+      'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+      'results': results,
+      }
+    bfile = open(args.save, 'w')
+    json.dump(baseline, bfile, indent=1)
+    bfile.close()
+
+  if args.compare:
+    bfile = open(args.compare, 'r')
+    baseline = json.load(bfile)
+    bfile.close()
+    if compare(results, baseline, key_fields, key_format, args.tolerance) > 0:
+      return 1
+  return 0
@@ -0,0 +1,78 @@
+"""Benchmark the MVTConvert frame gather on synthetic 4D arrays.
+
+Drives MVTConvertLogic.convertArray directly on synthetic int16
+[z][y][x][frame] arrays, so no DICOM MultiVolume, scene or GUI is involved.
+For every combination of frame count, ZSlices per frame, frame interval and
+padding it reports the time taken, throughput (MB/s of output volume) and the
+peak memory allocated by the conversion.  Baselines are saved and compared
+as described in MVTBenchmark.  Run it with Slicer's Python so that the module
+imports resolve, e.g.
+
+  Slicer --no-main-window --python-script MVTConvertBenchmark.py --save baseline.json
+  Slicer --no-main-window --python-script MVTConvertBenchmark.py --compare baseline.json
+"""
+
+import os
+import sys
+import itertools
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from MVTConvert import MVTConvertLogic
+import MVTBenchmark
+
+# (output frames, zslices, frame intervals, pad) for the full and --quick grids
+FULL_GRID = ((50, 500, 2000), (1, 4), (1, 3), (True, False))
+QUICK_GRID = ((50, 500), (1, 4), (1,), (True,))
+
+# [z][y][x] of the synthetic MultiVolume; the frame axis is sized to the grid
+SOURCE_SHAPE = (8, 256, 256)
+KEY_FIELDS = ('frames', 'zslices', 'finterval', 'pad')
+
+
+def synthetic_multivolume(nframes, finterval, seed = 0):
+  """Return a [z][y][x][frame] int16 array with enough frames for nframes
+  output frames taken finterval apart
+  """
+  max_z = -(-nframes * finterval // SOURCE_SHAPE[0])
+  rs = np.random.RandomState(seed)
+  return rs.randint(-1000, 100, size=SOURCE_SHAPE + (max_z,)).astype(np.int16)
+
+
+def run_grid(grid, repeats):
+  logic = MVTConvertLogic()
+  results = []
+  for frames, zslices, finterval, pad in itertools.product(*grid):
+    a = synthetic_multivolume(frames, finterval)
+    args = (a, 0, frames, finterval, zslices, pad)
+    # keep only the size of each output, not the output itself
+    timings = [(seconds, out.nbytes) for seconds, out in
+      (MVTBenchmark.time_call(logic.convertArray, *args) for r in range(0, repeats))]
+    elapsed = min(t[0] for t in timings)
+    payload = timings[0][1]
+    peak = MVTBenchmark.peak_memory(logic.convertArray, *args)
+    result = {
+      'frames': frames,
+      'zslices': zslices,
+      'finterval': finterval,
+      'pad': pad,
+      'seconds': elapsed,
+      'mb_per_s': payload / elapsed / 1e6,
+      'peak_mb': peak / 1e6,
+      }
+    results.append(result)
+    print('%6d %7d %9d %-5s %9.3f %9.1f %9.1f' % (frames, zslices, finterval, pad,
+      result['seconds'], result['mb_per_s'], result['peak_mb']))
+    sys.stdout.flush()
+  return results
+
+
+def main(argv):
+  return MVTBenchmark.main(argv, 'Benchmark the MVTConvert frame gather.',
+    'conversions per configuration; the fastest is reported',
+    '%6s %7s %9s %-5s %9s %9s %9s' % ('frames', 'zslices', 'finterval', 'pad', 'seconds', 'MB/s', 'peak MB'),
+    run_grid, FULL_GRID, QUICK_GRID, KEY_FIELDS, '%6d %7d %9d %-5s')
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv[1:]))